@@ -4,6 +4,7 @@
 #
 
 import argparse
+import datetime
 import logging
 import os
 import concurrent.futures
@@ -11,7 +12,7 @@ import multiprocessing
 
 from dotenv import load_dotenv
 from tqdm import tqdm
-from skylark import crud, feature, scraper
+from skylark import archive, crud, feature, intermediate, scraper, writer
 
 load_dotenv()
 
@@ -69,18 +70,175 @@ parser.add_argument('-U', '--update-race-list',
                     default=False,
                     help='Update race list(default: False)',)
 
+# incremental update of race list
+parser.add_argument('--incremental',
+                    action='store_true',
+                    default=False,
+                    help='Update race list only after the latest race date in database(default: False)',)
+
+# overlap days of incremental update
+parser.add_argument('--overlap-days',
+                    action='store',
+                    nargs='?',
+                    const=None,
+                    default=7,
+                    type=int,
+                    choices=None,
+                    help='overlap days before the latest race date in incremental update(default: 7)',
+                    metavar=None)
+
+# revalidate recent races
+parser.add_argument('--revalidate',
+                    action='store',
+                    nargs='?',
+                    const=7,
+                    default=None,
+                    type=int,
+                    choices=None,
+                    help='Re-check archived races held within DAYS days with conditional GET(default: None, DAYS: 7)',
+                    metavar='DAYS')
+
 # scraping mode
 parser.add_argument('-S', '--scraping',
                     action='store_true',
                     default=False,
                     help='scraping mode(default: False)',)
 
+# force scraping
+parser.add_argument('--force',
+                    action='store_true',
+                    default=False,
+                    help='Scrape races even if already stored in database(default: False)',)
+
+# worker mode
+parser.add_argument('-W', '--worker',
+                    action='store_true',
+                    default=False,
+                    help='Worker mode, claim race IDs from crawl queue in database(default: False)',)
+
+# reingest mode
+parser.add_argument('--reingest',
+                    action='store_true',
+                    default=False,
+                    help='Reingest cached race.<id>.html.zst files in temp directory without network(default: False)',)
+
+# write parsed races to parquet
+parser.add_argument('--write-parsed',
+                    action='store_true',
+                    default=False,
+                    help='Write parsed races to parquet files in temp directory(default: False)',)
+
+# load parsed races from parquet
+parser.add_argument('--load-parsed',
+                    action='store_true',
+                    default=False,
+                    help='Store parsed races in parquet files into database without parsing HTML(default: False)',)
+
+# reparse mode
+parser.add_argument('--reparse',
+                    action='store_true',
+                    default=False,
+                    help='Reparse archived races stored by older parser version and update them(default: False)',)
+
+# reingest race ID range
+parser.add_argument('--race-id-from',
+                    action='store',
+                    nargs='?',
+                    const=None,
+                    default=None,
+                    type=int,
+                    choices=None,
+                    help='Reingest race ID from(default: None)',
+                    metavar='RACE_ID')
+
+parser.add_argument('--race-id-to',
+                    action='store',
+                    nargs='?',
+                    const=None,
+                    default=None,
+                    type=int,
+                    choices=None,
+                    help='Reingest race ID to(default: None)',
+                    metavar='RACE_ID')
+
+# reingest date range
+parser.add_argument('--date-from',
+                    action='store',
+                    nargs='?',
+                    const=None,
+                    default=None,
+                    type=datetime.date.fromisoformat,
+                    choices=None,
+                    help='Reingest race date from, YYYY-MM-DD(default: None)',
+                    metavar='DATE')
+
+parser.add_argument('--date-to',
+                    action='store',
+                    nargs='?',
+                    const=None,
+                    default=None,
+                    type=datetime.date.fromisoformat,
+                    choices=None,
+                    help='Reingest race date to, YYYY-MM-DD(default: None)',
+                    metavar='DATE')
+
+# migrate race.<id>.html.zst files into archive
+parser.add_argument('--migrate-archive',
+                    action='store_true',
+                    default=False,
+                    help='Import race.<id>.html.zst files in temp directory into packed archive(default: False)',)
+
+parser.add_argument('--remove-loose-files',
+                    action='store_true',
+                    default=False,
+                    help='Remove race.<id>.html.zst files after importing into archive(default: False)',)
+
+# compare lxml parser with pyquery parser on archived pages
+parser.add_argument('--verify-parser',
+                    action='store',
+                    nargs='?',
+                    const=0,
+                    default=None,
+                    type=int,
+                    choices=None,
+                    help='Compare lxml parser output and speed with pyquery parser on archived pages, 0: all(default: None)',
+                    metavar='LIMIT')
+
+# train zstd dictionary from archived pages
+parser.add_argument('--train-dictionary',
+                    action='store_true',
+                    default=False,
+                    help='Train zstd dictionary from archived pages and use it for new pages(default: False)',)
+
+parser.add_argument('--compression-report',
+                    action='store_true',
+                    default=False,
+                    help='Report archive size and bytes saved by zstd dictionary(default: False)',)
+
 # feature mode
 parser.add_argument('-F', '--feature',
                     action='store_true',
                     default=False,
                     help='feature mode(default: False)',)
 
+# feature mode (per row)
+parser.add_argument('--feature-per-row',
+                    action='store_true',
+                    default=False,
+                    help='Calculate features row by row with database queries instead of whole table(default: False)',)
+
+# feature mode (stream)
+parser.add_argument('--feature-stream',
+                    action='store_true',
+                    default=False,
+                    help='Calculate features by replaying races in date order and resume from saved state in temp directory(default: False)',)
+
+# feature mode (from parsed parquet)
+parser.add_argument('--feature-from-parsed',
+                    action='store_true',
+                    default=False,
+                    help='Calculate features from parsed races in parquet files in temp directory instead of reading race results from database(default: False)',)
+
 # debug mode
 parser.add_argument('--debug',
                     action='store_true',
@@ -127,11 +285,43 @@ db_config: dict = {
 sqlalchemy_db_url: str = "{protocol:s}://{username:s}:{password:s}@{hostname:s}:{port:d}/{dbname:s}?charset={charset:s}".\
     format(**db_config)
 
-def process_feature(args_tuple):
-    sqlalchemy_db_url, args, logger, race_result = args_tuple
-    db_crud = crud.SkylarkCrud(sqlalchemy_db_url, logger=logger)
+# 特徴量を計算するワーカープロセスのDB接続(ワーカー毎に1つのエンジン)と、書き込みプロセスへのキュー
+worker_db_crud: crud.SkylarkCrud|None = None
+worker_feature_queue = None
+worker_feature_stopped = None
+
+def init_feature_worker(sqlalchemy_db_url: str, feature_queue, feature_stopped):
+    global worker_db_crud, worker_feature_queue, worker_feature_stopped
+    # fork で引き継いだ親プロセスの接続プールは使わない
+    crud.SkylarkCrud.forget_engines()
+    worker_db_crud = crud.SkylarkCrud(sqlalchemy_db_url, logger=logger)
+    worker_feature_queue = feature_queue
+    worker_feature_stopped = feature_stopped
+
+def process_feature_horses(horse_ids: list[int]) -> int:
+    # 馬毎に全ての出走結果を1度だけ読み込み、特徴量がない・古くなった行を計算して書き込みプロセスへ送る
+    source = worker_db_crud.get_feature_source(horse_ids)
+    states = worker_db_crud.get_feature_states(horse_ids)
+    engine = feature.SkylarkFeatureEngine(logger=logger)
+    dataset_list = engine.compute(source, states)
+    if len(dataset_list) > 0:
+        writer.put_features(worker_feature_queue, worker_feature_stopped, dataset_list)
+    return len(dataset_list)
+
+def process_feature(race_result_keys: list[tuple[int, int]]) -> int:
     skylark_feature = feature.SkylarkFeature(args=args, logger=logger)
-    skylark_feature.initialize(db_crud, race_id=race_result.race_id, horse_number=race_result.horse_number)
+    dataset_list = []
+    for race_id, horse_number in race_result_keys:
+        dataset = skylark_feature.initialize(worker_db_crud, race_id=race_id, horse_number=horse_number, write=False)
+        if dataset is not None:
+            dataset_list.append(dataset)
+    if len(dataset_list) > 0:
+        writer.put_features(worker_feature_queue, worker_feature_stopped, dataset_list)
+    return len(race_result_keys)
+
+def chunk_by_horse(horse_ids: list[int], chunk_size: int) -> list[list[int]]:
+    # 馬ID順に並んだIDを、連続した範囲毎に分割
+    return [horse_ids[start:start + chunk_size] for start in range(0, len(horse_ids), chunk_size)]
 
 def main(args: argparse.Namespace, logger: logging.Logger, sqlalchemy_db_url: str):
     args.temp = os.path.normcase(args.temp)
@@ -153,8 +343,13 @@ def main(args: argparse.Namespace, logger: logging.Logger, sqlalchemy_db_url: st
             instance = scraper.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
             if args.update_race_list == True:
                 logger.info("make race URL list")
-                instance.make_race_url_list(period = args.period_of_months)
+                if args.incremental == True:
+                    instance.update_race_url_list_incremental(period = args.period_of_months, overlap_days = args.overlap_days)
+                else:
+                    instance.make_race_url_list(period = args.period_of_months)
                 instance.export_race_url_list()
+                # ワーカー(-W)が取得するジョブキューへ登録
+                instance.seed_crawl_queue()
 
         if args.scraping == True:
             instance = scraper.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
@@ -167,18 +362,120 @@ def main(args: argparse.Namespace, logger: logging.Logger, sqlalchemy_db_url: st
             instance.download()
             logger.info("End download race data")
 
-        if args.feature == True or args.rebuild_feature == True:
-            race_result_list = db_crud.get_race_results()
-            if not race_result_list:
-                logger.warning("Failed to retrieve race results.")
-                return
+        if args.migrate_archive == True:
+            with archive.SkylarkRawArchive(os.path.join(args.temp, "archive"), logger = logger) as raw_archive:
+                logger.info("Start migrate archive")
+                imported, skipped = raw_archive.import_loose_files(args.temp, remove = args.remove_loose_files)
+                logger.info("End migrate archive: imported %d, skipped %d", imported, skipped)
+
+        if args.verify_parser is not None:
+            instance = scraper.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
+            logger.info("Start verify parser")
+            instance.verify_parser(
+                race_id_from = args.race_id_from,
+                race_id_to = args.race_id_to,
+                limit = args.verify_parser if args.verify_parser > 0 else None)
+            logger.info("End verify parser")
+
+        if args.train_dictionary == True:
+            with archive.SkylarkRawArchive(os.path.join(args.temp, "archive"), logger = logger) as raw_archive:
+                logger.info("Start train dictionary")
+                raw_archive.train_dictionary(
+                    samples = int(os.getenv("ZSTD_DICT_SAMPLES", 2000)),
+                    dict_size = int(os.getenv("ZSTD_DICT_SIZE", 112640)))
+                logger.info("End train dictionary")
+
+        if args.compression_report == True:
+            with archive.SkylarkRawArchive(os.path.join(args.temp, "archive"), logger = logger) as raw_archive:
+                raw_archive.compression_report()
+
+        if args.worker == True:
+            instance = scraper.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
+            logger.info("Start worker")
+            instance.work_queue()
+            logger.info("End worker")
+
+        if args.reingest == True:
+            instance = scraper.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
+            logger.info("Start reingest race data")
+            instance.reingest(
+                race_id_from = args.race_id_from,
+                race_id_to = args.race_id_to,
+                date_from = args.date_from,
+                date_to = args.date_to
+            )
+            logger.info("End reingest race data")
+
+        if args.load_parsed == True:
+            instance = scraper.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
+            logger.info("Start load parsed race data")
+            instance.load_parsed(date_from = args.date_from, date_to = args.date_to)
+            logger.info("End load parsed race data")
+
+        if args.reparse == True:
+            instance = scraper.SkylarkScraperDb(sqlalchemy_db_url, args = args, logger = logger)
+            logger.info("Start reparse race data")
+            instance.reparse(race_id_from = args.race_id_from, race_id_to = args.race_id_to)
+            logger.info("End reparse race data")
 
-            logger.info("Start feature")
+        if args.feature == True or args.rebuild_feature == True:
             max_workers = min(8, multiprocessing.cpu_count())
-            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
-                args_iter = ((sqlalchemy_db_url, args, logger, race_result) for race_result in race_result_list)
-                list(tqdm(executor.map(process_feature, args_iter), total=len(race_result_list)))
-            logger.info("End feature")
+            chunk_size = int(os.getenv("FEATURE_CHUNK_HORSES", 500))
+            if args.feature_per_row == True:
+                race_result_keys = db_crud.get_race_result_keys()
+                if not race_result_keys:
+                    logger.warning("Failed to retrieve race results.")
+                    return
+
+                keys_by_horse: dict[int, list[tuple[int, int]]] = {}
+                for horse_id, race_id, horse_number in race_result_keys:
+                    keys_by_horse.setdefault(horse_id, []).append((race_id, horse_number))
+                chunks = [
+                    [key for horse_id in horse_ids for key in keys_by_horse[horse_id]]
+                    for horse_ids in chunk_by_horse(list(keys_by_horse.keys()), chunk_size)
+                ]
+
+                logger.info("Start feature")
+                with writer.SkylarkFeatureWriter(sqlalchemy_db_url, logger=logger) as feature_writer:
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                            initializer=init_feature_worker, initargs=(sqlalchemy_db_url, feature_writer.queue, feature_writer.stopped)) as executor:
+                        with tqdm(total=len(race_result_keys)) as progress:
+                            for count in executor.map(process_feature, chunks):
+                                progress.update(count)
+                logger.info("End feature")
+            elif args.feature_stream == True:
+                logger.info("Start feature")
+                stream = feature.SkylarkFeatureStream(os.path.join(args.temp, "feature_state.pickle"), logger=logger)
+                if args.rebuild_feature == True:
+                    stream.remove_snapshot()
+                written = stream.run(db_crud)
+                logger.info("End feature: %d rows", written)
+            elif args.feature_from_parsed == True:
+                logger.info("Start feature")
+                # 出走結果をデータベースから読まず、Parquetファイルのパース結果から計算
+                parsed_store = intermediate.SkylarkParsedStore(os.path.join(args.temp, "parsed"), logger=logger)
+                frame = parsed_store.read_race_results()
+                logger.info("parsed race results: %d", len(frame))
+                engine = feature.SkylarkFeatureEngine(logger=logger)
+                dataset_list = engine.compute(frame, db_crud.get_feature_states())
+                # feature_tbl は race_result_tbl を参照するため、データベースにある出走結果の行のみ書き込む
+                race_result_keys = {(race_id, horse_id) for horse_id, race_id, _ in db_crud.get_race_result_keys()}
+                dataset_list = [dataset for dataset in dataset_list
+                    if (dataset["race_id"], dataset["horse_id"]) in race_result_keys]
+                db_crud.upsert_features(dataset_list)
+                logger.info("End feature: %d rows", len(dataset_list))
+            else:
+                logger.info("Start feature")
+                # 特徴量がない・古くなった行がある馬のみ、馬IDの範囲毎にワーカーで計算
+                horse_ids = db_crud.get_feature_horse_ids(feature.FEATURE_VERSION)
+                chunks = chunk_by_horse(horse_ids, chunk_size)
+                logger.info("horses to update: %d", len(horse_ids))
+                # 計算はワーカー、書き込みは1つの書き込みプロセスで行う
+                with writer.SkylarkFeatureWriter(sqlalchemy_db_url, logger=logger) as feature_writer:
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                            initializer=init_feature_worker, initargs=(sqlalchemy_db_url, feature_writer.queue, feature_writer.stopped)) as executor:
+                        list(tqdm(executor.map(process_feature_horses, chunks), total=len(chunks)))
+                logger.info("End feature")
 
     except Exception as ex:
         logger.error(ex,exc_info=True)
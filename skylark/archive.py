@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import fcntl
+import functools
+import json
+from logging import Logger
+import mmap
+import os
+import random
+import re
+import struct
+import threading
+import time
+from typing import Iterator
+import zstandard as zstd
+
+# pages.pack のレコード: magic, メタデータ長, ペイロード長, メタデータ(JSON), ペイロード(zstd)
+_RECORD_HEADER = struct.Struct("<4sII")
+_RECORD_MAGIC = b"SKP1"
+
+# pages.idx のエントリ(32バイト、リトルエンディアン、アラインメントなし):
+#   0: race_id (uint64), 8: offset (uint64), 16: length (uint32), 20: fetched_at (double), 28: 予約(4バイト、0)
+# 予約の4バイトは以前のパーサーのバージョン(uint16)と詰め物(2バイト)で、読み込み時は無視する
+# パーサーのバージョンはアーカイブではなく race_info_tbl.parser_version で管理する
+_INDEX_ENTRY = struct.Struct("<QQId4x")
+
+@functools.lru_cache(maxsize=16)
+def _load_dictionary(dict_dir: str, dict_id: int) -> zstd.ZstdCompressionDict:
+    with open(os.path.join(dict_dir, f"{dict_id}.zdict"), "rb") as f:
+        return zstd.ZstdCompressionDict(f.read())
+
+def decompress_page(payload: bytes, dict_dir: str|None) -> bytes:
+    """
+    zstdフレームのヘッダに記録された辞書IDの辞書で展開します。辞書ID 0 は辞書なしの旧形式です。
+    パース用のワーカープロセスからも呼び出すため、辞書はディレクトリとIDから読み込みます。
+    """
+    dict_id = zstd.get_frame_parameters(payload).dict_id
+    if dict_id == 0 or dict_dir is None:
+        decompressor = zstd.ZstdDecompressor()
+    else:
+        decompressor = zstd.ZstdDecompressor(dict_data=_load_dictionary(dict_dir, dict_id))
+    # ストリーミング圧縮したフレームはヘッダに展開後のサイズを持たないため、decompressobj で展開する
+    return decompressor.decompressobj().decompress(payload)
+
+class SkylarkRawArchive:
+    """
+    レースページを1ファイルずつではなく、追記専用のパックファイル(pages.pack)と
+    固定長のインデックス(pages.idx)に格納します。
+    同じ race_id のエントリが複数ある場合は、後から追記されたものが有効です。
+    """
+    def __init__(self, directory: str, logger: Logger):
+        self.directory = directory
+        self.logger = logger
+        os.makedirs(directory, exist_ok=True)
+
+        self.pack_path = os.path.join(directory, "pages.pack")
+        self.index_path = os.path.join(directory, "pages.idx")
+
+        self.pack_file = open(self.pack_path, "a+b")
+        self.index_file = open(self.index_path, "a+b")
+        self.lock = threading.Lock()
+
+        # race_id -> (offset, length, fetched_at)
+        self.index: dict[int, tuple[int, int, float]] = {}
+        self.index_size: int = 0
+        self.mmap: mmap.mmap|None = None
+        self.mmap_size: int = 0
+
+        self._load_index()
+
+        # 学習済みzstd辞書(dict/<dict_id>.zdict)と、新規ページの圧縮に使う辞書ID(dict/current)
+        self.dict_dir = os.path.join(directory, "dict")
+        self.compression_level: int = int(os.environ.get("ZSTD_LEVEL", 3))
+        self.dict_id: int = 0
+        current_path = os.path.join(self.dict_dir, "current")
+        if os.path.isfile(current_path):
+            with open(current_path, "r") as f:
+                self.dict_id = int(f.read().strip() or 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, race_id: int) -> bool:
+        if race_id in self.index:
+            return True
+        # 他のプロセスが追記している場合があるため、見つからなければインデックスの末尾を読み直す
+        self._load_index()
+        return race_id in self.index
+
+    def close(self) -> None:
+        with self.lock:
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+            self.pack_file.close()
+            self.index_file.close()
+
+    # インデックスを前回読み込んだ位置から読み込み
+    def _load_index(self) -> None:
+        with self.lock:
+            size = os.fstat(self.index_file.fileno()).st_size
+            # 書き込み途中の不完全なエントリは読み込まない
+            size -= size % _INDEX_ENTRY.size
+            if size <= self.index_size:
+                return
+
+            self.index_file.seek(self.index_size)
+            data = self.index_file.read(size - self.index_size)
+            for race_id, offset, length, fetched_at in _INDEX_ENTRY.iter_unpack(data):
+                self.index[race_id] = (offset, length, fetched_at)
+            self.index_size = size
+
+    def _map(self, end: int) -> mmap.mmap:
+        if self.mmap is None or self.mmap_size < end:
+            if self.mmap is not None:
+                self.mmap.close()
+            self.pack_file.flush()
+            self.mmap_size = os.fstat(self.pack_file.fileno()).st_size
+            self.mmap = mmap.mmap(self.pack_file.fileno(), self.mmap_size, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def _read_record(self, offset: int, length: int) -> tuple[dict, bytes]:
+        with self.lock:
+            view = self._map(offset + length)
+            record = view[offset:offset + length]
+
+        magic, meta_length, payload_length = _RECORD_HEADER.unpack_from(record)
+        if magic != _RECORD_MAGIC:
+            raise ValueError(f"broken record at offset {offset}")
+        start = _RECORD_HEADER.size
+        meta = json.loads(record[start:start + meta_length]) if meta_length > 0 else {}
+        start += meta_length
+        return meta, record[start:start + payload_length]
+
+    def entry(self, race_id: int) -> tuple[int, int, float]|None:
+        if race_id not in self:
+            return None
+        return self.index[race_id]
+
+    def get(self, race_id: int) -> tuple[dict, bytes]|None:
+        """
+        (メタデータ, zstd圧縮されたページ) を取得します。
+        """
+        entry = self.entry(race_id)
+        if entry is None:
+            return None
+        return self._read_record(entry[0], entry[1])
+
+    def put(self, race_id: int, payload: bytes, meta: dict|None = None,
+            fetched_at: float|None = None) -> None:
+        """
+        zstd圧縮済みのページを追記します。複数プロセスからの追記はファイルロックで直列化します。
+        """
+        if fetched_at is None:
+            fetched_at = time.time()
+        meta_bytes = json.dumps(meta, ensure_ascii=False, sort_keys=True).encode("utf-8") if meta else b""
+        record = _RECORD_HEADER.pack(_RECORD_MAGIC, len(meta_bytes), len(payload)) + meta_bytes + payload
+
+        with self.lock:
+            fcntl.flock(self.pack_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.pack_file.seek(0, os.SEEK_END)
+                offset = self.pack_file.tell()
+                self.pack_file.write(record)
+                self.pack_file.flush()
+
+                # データを書き込んでからインデックスを追記し、未書き込みの位置を指さないようにする
+                self.index_file.seek(0, os.SEEK_END)
+                self.index_file.write(_INDEX_ENTRY.pack(race_id, offset, len(record), fetched_at))
+                self.index_file.flush()
+            finally:
+                fcntl.flock(self.pack_file.fileno(), fcntl.LOCK_UN)
+
+            self.index[race_id] = (offset, len(record), fetched_at)
+
+    def compressor(self) -> zstd.ZstdCompressor:
+        if self.dict_id == 0:
+            return zstd.ZstdCompressor(level=self.compression_level)
+        return zstd.ZstdCompressor(level=self.compression_level, dict_data=_load_dictionary(self.dict_dir, self.dict_id))
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor().compress(data)
+
+    def decompress(self, payload: bytes) -> bytes:
+        return decompress_page(payload, self.dict_dir)
+
+    def train_dictionary(self, samples: int, dict_size: int) -> int:
+        """
+        アーカイブ内のページからzstd辞書を学習し、以降の圧縮に使用します。
+        学習に使わなかったページで、辞書なし・辞書ありの圧縮サイズを比較して記録します。
+        """
+        race_ids = self.race_ids()
+        if len(race_ids) < 10:
+            raise ValueError("not enough pages to train dictionary")
+
+        sampled = random.sample(race_ids, min(len(race_ids), samples * 2))
+        train_ids = sampled[:len(sampled) // 2]
+        test_ids = sampled[len(sampled) // 2:]
+
+        train_pages = [self.decompress(payload) for _, _, payload in self.scan(train_ids)]
+        dictionary = zstd.train_dictionary(dict_size, train_pages, level=self.compression_level)
+        dict_id = dictionary.dict_id()
+
+        os.makedirs(self.dict_dir, exist_ok=True)
+        with open(os.path.join(self.dict_dir, f"{dict_id}.zdict"), "wb") as f:
+            f.write(dictionary.as_bytes())
+        with open(os.path.join(self.dict_dir, "current"), "w") as f:
+            f.write(str(dict_id))
+        self.dict_id = dict_id
+
+        raw_bytes = 0
+        plain_bytes = 0
+        dict_bytes = 0
+        plain_compressor = zstd.ZstdCompressor(level=self.compression_level)
+        dict_compressor = self.compressor()
+        for _, _, payload in self.scan(test_ids):
+            page = self.decompress(payload)
+            raw_bytes += len(page)
+            plain_bytes += len(plain_compressor.compress(page))
+            dict_bytes += len(dict_compressor.compress(page))
+
+        self.logger.info("dictionary: id %d, %d bytes, trained with %d pages", dict_id, len(dictionary.as_bytes()), len(train_pages))
+        if plain_bytes > 0:
+            self.logger.info("test %d pages: raw %d bytes, zstd %d bytes, zstd+dict %d bytes, saved %d bytes (%.1f%%)",
+                len(test_ids), raw_bytes, plain_bytes, dict_bytes, plain_bytes - dict_bytes, 100.0 * (plain_bytes - dict_bytes) / plain_bytes)
+            archive_bytes = sum(entry[1] for entry in self.index.values())
+            self.logger.info("estimated saving for %d archived pages: %d bytes",
+                len(race_ids), int(archive_bytes * (plain_bytes - dict_bytes) / plain_bytes))
+        return dict_id
+
+    def compression_report(self, sample: int = 1000) -> None:
+        """
+        辞書ID毎のページ数と圧縮後サイズ、辞書による削減量(辞書なしで圧縮した場合のサイズとの差)を出力します。
+        辞書なしのサイズを記録していないページ(取得時に辞書で圧縮したページ)は、
+        辞書ID毎に最大 sample ページを辞書なしで圧縮し直した比率から推定します。
+        """
+        plain_compressor = zstd.ZstdCompressor(level=self.compression_level)
+        # 辞書ID -> [ページ数, 圧縮後サイズ, 辞書なしのサイズの記録がないページ数, その圧縮後サイズ, 記録済み・推定済みの辞書なしサイズ]
+        totals: dict[int, list[int]] = {}
+        # 辞書ID -> [標本の圧縮後サイズ, 標本の辞書なしサイズ, 標本数]
+        samples: dict[int, list[int]] = {}
+        for _, meta, payload in self.scan():
+            dict_id = zstd.get_frame_parameters(payload).dict_id
+            total = totals.setdefault(dict_id, [0, 0, 0, 0, 0])
+            total[0] += 1
+            total[1] += len(payload)
+            if dict_id == 0:
+                total[4] += len(payload)
+            elif "plain_size" in meta:
+                total[4] += int(meta["plain_size"])
+            else:
+                total[2] += 1
+                total[3] += len(payload)
+                sampled = samples.setdefault(dict_id, [0, 0, 0])
+                if sampled[2] < sample:
+                    sampled[0] += len(payload)
+                    sampled[1] += len(plain_compressor.compress(decompress_page(payload, self.dict_dir)))
+                    sampled[2] += 1
+
+        for dict_id, (pages, stored, unknown_pages, unknown_stored, plain) in sorted(totals.items()):
+            if unknown_pages > 0:
+                sample_stored, sample_plain, sampled = samples[dict_id]
+                plain += int(unknown_stored * sample_plain / sample_stored)
+                self.logger.info("dict_id %d: %d pages, %d bytes, saved %d bytes (%d pages estimated from %d samples)",
+                    dict_id, pages, stored, plain - stored, unknown_pages, sampled)
+            else:
+                self.logger.info("dict_id %d: %d pages, %d bytes, saved %d bytes", dict_id, pages, stored, plain - stored)
+
+    def race_ids(self) -> list[int]:
+        self._load_index()
+        return sorted(self.index.keys())
+
+    def scan(self, race_ids: list[int]|None = None) -> Iterator[tuple[int, dict, bytes]]:
+        """
+        (race_id, メタデータ, zstd圧縮されたページ) をパックファイル内の順に読み出します。
+        """
+        self._load_index()
+        if race_ids is None:
+            entries = list(self.index.items())
+        else:
+            entries = [(race_id, self.index[race_id]) for race_id in race_ids if race_id in self.index]
+        # オフセット順に読むことで、mmap上をシーケンシャルに走査する
+        entries.sort(key=lambda item: item[1][0])
+
+        for race_id, (offset, length, _) in entries:
+            meta, payload = self._read_record(offset, length)
+            yield race_id, meta, payload
+
+    def import_loose_files(self, temp_dir: str, remove: bool = False) -> tuple[int, int]:
+        """
+        既存の race.<id>.html.zst をアーカイブへ取り込みます。戻り値は (取り込み件数, スキップ件数) です。
+        """
+        pattern = re.compile(r"^race\.([0-9]{12})\.html\.zst$")
+        imported = 0
+        skipped = 0
+
+        with os.scandir(temp_dir) as entries:
+            loose_files = sorted((entry.name, entry.path) for entry in entries if pattern.match(entry.name))
+
+        for name, path in loose_files:
+            matchese = pattern.match(name)
+            assert matchese is not None
+            race_id = int(matchese.group(1))
+
+            if race_id in self:
+                skipped += 1
+            else:
+                with open(path, "rb") as f:
+                    payload = f.read()
+                meta = {"charset": "utf-8"}  # 旧形式のファイルはUTF-8に変換して保存されている
+                if self.dict_id != 0:
+                    meta["plain_size"] = len(payload)
+                    payload = self.compress(decompress_page(payload, None))
+                self.put(race_id, payload, meta=meta, fetched_at=os.path.getmtime(path))
+                imported += 1
+
+            if remove:
+                os.remove(path)
+
+            if (imported + skipped) % 10000 == 0:
+                self.logger.info("import: %d / %d", imported + skipped, len(loose_files))
+
+        return (imported, skipped)
@@ -5,13 +5,22 @@
 # This software is released under the MIT License.
 #
 
+import datetime
 import os
+import random
 from logging import Logger
-from sqlalchemy import create_engine, desc, func
+from typing import Iterator
+import pandas as pd
+from sqlalchemy import create_engine, desc, func, inspect, or_, select, text, tuple_, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.engine import Connection
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError
 
-from skylark.models import Base, Feature, Horse, Jockey, Trainer, Owner, RaceInfo, RaceResult, Payoff
+from skylark.models import Base, CrawlJob, Feature, Horse, Jockey, Trainer, Owner, RaceInfo, RaceResult, Payoff
+
+# 再試行しないジョブの状態(取り込み済み・再試行しても結果が変わらない失敗)
+CRAWL_DONE_STATUSES = ("stored", "rejected")
 
 class SkylarkCrud:
     _engines: dict = {}
@@ -20,6 +29,10 @@ class SkylarkCrud:
     def __init__(self, db_url: str, logger: Logger):
         self.db_url = db_url
         self.logger: Logger = logger
+        self.bulk_batch_size: int = int(os.getenv("DB_BULK_BATCH_SIZE", "1000"))
+        self.feature_batch_size: int = int(os.getenv("FEATURE_UPSERT_BATCH_SIZE", "2000"))
+        self.crawl_retry_base: float = float(os.getenv("CRAWL_RETRY_BASE", "30"))
+        self.crawl_retry_max: float = float(os.getenv("CRAWL_RETRY_MAX", "1800"))
 
         if db_url in SkylarkCrud._sessionmakers:
             self.engine = SkylarkCrud._engines[db_url]
@@ -53,8 +66,46 @@ class SkylarkCrud:
         cls._engines.clear()
         cls._sessionmakers.clear()
 
+    @classmethod
+    def forget_engines(cls):
+        """
+        fork した子プロセスで、親プロセスから引き継いだ接続プールを破棄します。
+        接続は親プロセスと共有しているため閉じずに手放し、子プロセスでは新しいエンジンを作成させます。
+        """
+        for e in cls._engines.values():
+            e.dispose(close=False)
+        cls._engines.clear()
+        cls._sessionmakers.clear()
+
     def create_tables(self):
         Base.metadata.create_all(self.engine)
+        self.ensure_columns()
+
+    # 既存のテーブルに、後から追加した列・インデックスを追加
+    def ensure_columns(self):
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                if inspector.has_table(table.name) == False:
+                    continue
+
+                existing = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    if column.server_default is not None:
+                        ddl += f" NOT NULL DEFAULT {column.server_default.arg}" if column.nullable == False \
+                            else f" DEFAULT {column.server_default.arg}"
+                    self.logger.info("add column: %s.%s", table.name, column.name)
+                    connection.execute(text(ddl))
+
+                existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+                for index in table.indexes:
+                    if index.name not in existing_indexes:
+                        self.logger.info("add index: %s.%s", table.name, index.name)
+                        index.create(connection)
 
     def create_table(self, table_name: str):
         try:
@@ -79,6 +130,105 @@ class SkylarkCrud:
         except Exception as ex:
             self.logger.error(f"{ex}")
 
+    def bulk_insert(self, model, dataset_list: list, update: bool = False, connection: Connection|None = None,
+                    batch_size: int|None = None) -> tuple[int, int]:
+        """
+        ORMオブジェクトを作らず、バッチ(既定は DB_BULK_BATCH_SIZE 件)毎に1文の複数行INSERTで書き込みます。
+        update=False は主キーが重複する行を変更しない INSERT ... ON DUPLICATE KEY UPDATE (主キー = 主キー)、
+        update=True は既存の行を更新する INSERT ... ON DUPLICATE KEY UPDATE です。
+        INSERT IGNORE と違い、NOT NULLや値の範囲などのエラーは警告にならずに例外になります。
+        戻り値は (書き込み件数, スキップ件数) です。update=True では全件を書き込み件数とします。
+        """
+        if len(dataset_list) == 0:
+            return (0, 0)
+
+        if connection is None:
+            with self.engine.begin() as connection:
+                return self.bulk_insert(model, dataset_list, update=update, connection=connection, batch_size=batch_size)
+
+        if batch_size is None:
+            batch_size = self.bulk_batch_size
+        table = model.__table__
+        written = 0
+        for start in range(0, len(dataset_list), batch_size):
+            batch = dataset_list[start:start + batch_size]
+            stmt = mysql_insert(table).values(batch)
+            if update:
+                stmt = stmt.on_duplicate_key_update({
+                    key: stmt.inserted[key] for key in batch[0].keys() if not table.c[key].primary_key
+                })
+                connection.execute(stmt)
+                written += len(batch)
+            else:
+                # SQLAlchemy は CLIENT_FOUND_ROWS を付けて接続するため rowcount では重複行を区別できない。
+                # 書き込む前にある主キー(とバッチ内で重複する行)をスキップした件数とする
+                keys = [column.name for column in table.primary_key.columns]
+                seen = self._existing_keys(table, keys, batch, connection)
+                for dataset in batch:
+                    key = tuple(dataset[name] for name in keys)
+                    if key not in seen:
+                        seen.add(key)
+                        written += 1
+                stmt = stmt.on_duplicate_key_update({key: stmt.inserted[key] for key in keys})
+                connection.execute(stmt)
+
+        return (written, len(dataset_list) - written)
+
+    def _existing_keys(self, table, keys: list[str], batch: list[dict], connection: Connection) -> set[tuple]:
+        columns = [table.c[name] for name in keys]
+        values = {tuple(dataset[name] for name in keys) for dataset in batch}
+        if len(columns) == 1:
+            query = select(columns[0]).where(columns[0].in_([value[0] for value in values]))
+        else:
+            query = select(*columns).where(tuple_(*columns).in_(list(values)))
+        return {tuple(row) for row in connection.execute(query)}
+
+    def bulk_insert_race_info(self, dataset_list: list, update: bool = False, connection: Connection|None = None) -> tuple[int, int]:
+        return self.bulk_insert(RaceInfo, dataset_list, update=update, connection=connection)
+
+    def bulk_insert_horses(self, dataset_list: list, connection: Connection|None = None) -> tuple[int, int]:
+        return self.bulk_insert(Horse, dataset_list, connection=connection)
+
+    def bulk_insert_jockeys(self, dataset_list: list, connection: Connection|None = None) -> tuple[int, int]:
+        return self.bulk_insert(Jockey, dataset_list, connection=connection)
+
+    def bulk_insert_trainers(self, dataset_list: list, connection: Connection|None = None) -> tuple[int, int]:
+        return self.bulk_insert(Trainer, dataset_list, connection=connection)
+
+    def bulk_insert_owners(self, dataset_list: list, connection: Connection|None = None) -> tuple[int, int]:
+        return self.bulk_insert(Owner, dataset_list, connection=connection)
+
+    def bulk_insert_race_results(self, dataset_list: list, update: bool = False, connection: Connection|None = None) -> tuple[int, int]:
+        return self.bulk_insert(RaceResult, dataset_list, update=update, connection=connection)
+
+    def bulk_insert_payoffs(self, dataset_list: list, update: bool = False, connection: Connection|None = None) -> tuple[int, int]:
+        return self.bulk_insert(Payoff, dataset_list, update=update, connection=connection)
+
+    def store_races(self, record_list: list, update: bool = False) -> dict[str, tuple[int, int]]:
+        """
+        パース済みレース(race_info, horses, jockeys, trainers, owners, race_results, payoffs)を
+        1トランザクションで書き込みます。どれか1つでも失敗した場合は全体をロールバックします。
+        """
+        counts: dict[str, tuple[int, int]] = {}
+        with self.engine.begin() as connection:
+            counts["race_info"] = self.bulk_insert_race_info(
+                [record["race_info"] for record in record_list], update=update, connection=connection)
+            counts["horse"] = self.bulk_insert_horses(
+                [dataset for record in record_list for dataset in record["horses"]], connection=connection)
+            counts["jockey"] = self.bulk_insert_jockeys(
+                [dataset for record in record_list for dataset in record["jockeys"]], connection=connection)
+            counts["trainer"] = self.bulk_insert_trainers(
+                [dataset for record in record_list for dataset in record["trainers"]], connection=connection)
+            counts["owner"] = self.bulk_insert_owners(
+                [dataset for record in record_list for dataset in record["owners"]], connection=connection)
+            counts["race_result"] = self.bulk_insert_race_results(
+                [dataset for record in record_list for dataset in record["race_results"]], update=update, connection=connection)
+            counts["payoff"] = self.bulk_insert_payoffs(
+                [dataset for record in record_list for dataset in record["payoffs"]], update=update, connection=connection)
+            self.update_crawl_jobs_status(
+                [record["race_info"]["id"] for record in record_list], "stored", connection=connection)
+        return counts
+
     def get_horse(self, horse_id) -> Horse|None:
         with self.session() as session:
             try:
@@ -296,6 +446,52 @@ class SkylarkCrud:
                 session.rollback()
                 raise ex
 
+    def get_latest_race_date(self) -> datetime.date|None:
+        with self.session() as session:
+            try:
+                return session.query(func.max(RaceInfo.date)).scalar()
+            except Exception as ex:
+                self.logger.error(ex)
+        return None
+
+    def get_race_ids_since(self, date_from: datetime.date) -> list[int]:
+        """
+        開催日が date_from 以降のレースIDを取得します。
+        """
+        with self.session() as session:
+            rows = session.query(RaceInfo.id).filter(RaceInfo.date >= date_from).order_by(RaceInfo.id).all()
+            return [row[0] for row in rows]
+
+    def get_outdated_race_ids(self, parser_version: int, race_id_from: int|None = None, race_id_to: int|None = None) -> list[int]:
+        """
+        parser_version より古いパーサーで取り込んだレースIDを取得します。
+        """
+        with self.session() as session:
+            query = session.query(RaceInfo.id).filter(RaceInfo.parser_version < parser_version)
+            if race_id_from is not None:
+                query = query.filter(RaceInfo.id >= race_id_from)
+            if race_id_to is not None:
+                query = query.filter(RaceInfo.id <= race_id_to)
+            return [row[0] for row in query.order_by(RaceInfo.id).all()]
+
+    def get_stored_race_ids(self, race_id_from: int, race_id_to: int) -> set[int]:
+        """
+        race_info_tbl と race_result_tbl の両方に登録済みのレースIDを1回のクエリで取得します。
+        """
+        with self.session() as session:
+            try:
+                rows = (
+                    session.query(RaceInfo.id)
+                    .join(RaceResult, RaceInfo.id == RaceResult.race_id)
+                    .filter(RaceInfo.id.between(race_id_from, race_id_to))
+                    .distinct()
+                    .all()
+                )
+                return {row[0] for row in rows}
+            except Exception as ex:
+                self.logger.error(ex)
+        return set()
+
     def get_race_results(self) -> list[RaceResult] | None:
         with self.session() as session:
             try:
@@ -304,6 +500,22 @@ class SkylarkCrud:
                 self.logger.error(ex)
         return None
 
+    def get_race_result_keys(self) -> list[tuple[int, int, int]]:
+        """
+        全ての出走結果の (horse_id, race_id, horse_number) を馬ID順に返します。
+        """
+        with self.session() as session:
+            try:
+                rows = (
+                    session.query(RaceResult.horse_id, RaceResult.race_id, RaceResult.horse_number)
+                    .order_by(RaceResult.horse_id, RaceResult.race_id)
+                    .all()
+                )
+                return [tuple(row) for row in rows]
+            except Exception as ex:
+                self.logger.error(ex)
+        return []
+
     def get_race_result(self, race_id: int, horse_number: int) -> RaceResult|None:
         with self.session() as session:
             try:
@@ -386,28 +598,137 @@ class SkylarkCrud:
                 raise ex
 
     def upsert_features(self, dataset_list: list) -> None:
+        self.bulk_upsert_features(dataset_list)
+
+    def bulk_upsert_features(self, dataset_list: list, connection: Connection|None = None) -> tuple[int, int]:
+        """
+        特徴量を FEATURE_UPSERT_BATCH_SIZE 件毎の INSERT ... ON DUPLICATE KEY UPDATE で書き込みます。
+        """
+        return self.bulk_insert(Feature, dataset_list, update=True, connection=connection, batch_size=self.feature_batch_size)
+
+    def get_feature_horse_ids(self, feature_version: int) -> list[int]:
+        """
+        特徴量がない、または特徴量の定義のバージョンが古い出走結果がある馬のIDを返します。
+        新しい出走結果には特徴量がないため、過去走が増えた馬もここに含まれます。
+        """
         with self.session() as session:
             try:
-                for dataset in dataset_list:
-                    feature = Feature(**dataset)
-                    session.merge(feature)
-                session.commit()
+                rows = (
+                    session.query(RaceResult.horse_id)
+                    .outerjoin(Feature, (Feature.race_id == RaceResult.race_id) & (Feature.horse_id == RaceResult.horse_id))
+                    .filter(or_(Feature.race_id.is_(None), Feature.feature_version != feature_version))
+                    .distinct()
+                    .order_by(RaceResult.horse_id)
+                    .all()
+                )
+                return [row[0] for row in rows]
+            except Exception as ex:
+                self.logger.error(ex)
+        return []
 
-            except IntegrityError as ex:
-                session.rollback()
+    def get_feature_source(self, horse_ids: list[int]|None = None) -> pd.DataFrame:
+        """
+        特徴量の一括計算用に、出走結果へ開催日・距離を結合して返します。
+        horse_ids を指定した場合は、その馬の全ての出走結果のみ返します。
+        """
+        query = (
+            select(
+                RaceResult.race_id,
+                RaceResult.horse_number,
+                RaceResult.horse_id,
+                RaceResult.jockey_id,
+                RaceResult.trainer_id,
+                RaceResult.speed_figure,
+                RaceResult.order_of_finish,
+                RaceResult.earning_money,
+                RaceInfo.date,
+                RaceInfo.distance,
+            )
+            .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+            .order_by(RaceResult.horse_id, RaceInfo.date)
+        )
+        return self._read_by_horse_ids(query, RaceResult.horse_id, horse_ids)
 
-                orig = getattr(ex, "orig", None)
-                if orig is not None:
-                    args = getattr(orig, "args", ())
-                    if len(args) >= 1 and args[0] == 1062:
-                        msg = args[1] if len(args) >= 2 else str(orig)
-                        self.logger.info("Duplicate ignored in feature: %s", msg)
-                        return
-                raise ex
+    def iter_feature_source(self, date_after: datetime.date|None = None, batch_size: int|None = None) -> Iterator:
+        """
+        出走結果を開催日順に返します。サーバーサイドカーソルで batch_size 行ずつ取得するため、全件をメモリに載せません。
+        date_after を指定した場合は、その開催日より後のレースのみ返します。
+        """
+        query = (
+            select(
+                RaceResult.race_id,
+                RaceResult.horse_id,
+                RaceResult.jockey_id,
+                RaceResult.trainer_id,
+                RaceResult.speed_figure,
+                RaceResult.order_of_finish,
+                RaceResult.earning_money,
+                RaceInfo.date,
+                RaceInfo.distance,
+            )
+            .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+            .order_by(RaceInfo.date, RaceResult.race_id, RaceResult.horse_number)
+        )
+        if date_after is not None:
+            query = query.where(RaceInfo.date > date_after)
+
+        with self.engine.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True, yield_per=batch_size or self.bulk_batch_size).execute(query)
+            for row in result:
+                yield row
 
+    def count_race_results(self, date_to: datetime.date) -> int:
+        """
+        開催日が date_to 以前の出走結果の件数を返します。
+        """
+        with self.session() as session:
+            return (
+                session.query(func.count(RaceResult.race_id))
+                .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+                .filter(RaceInfo.date <= date_to)
+                .scalar()
+            )
+
+    def get_feature_states(self, horse_ids: list[int]|None = None) -> pd.DataFrame:
+        """
+        計算済みの特徴量の、定義のバージョンと計算時点の過去走の件数を返します。
+        """
+        query = select(Feature.race_id, Feature.horse_id, Feature.feature_version, Feature.history_count)
+        return self._read_by_horse_ids(query, Feature.horse_id, horse_ids)
+
+    def _read_by_horse_ids(self, query, column, horse_ids: list[int]|None) -> pd.DataFrame:
+        with self.engine.connect() as connection:
+            if horse_ids is None:
+                return pd.read_sql(query, connection)
+
+            # IN句が長くなりすぎないように分割
+            frames = [
+                pd.read_sql(query.where(column.in_(horse_ids[start:start + self.bulk_batch_size])), connection)
+                for start in range(0, len(horse_ids), self.bulk_batch_size)
+            ]
+            if len(frames) == 0:
+                return pd.read_sql(query.where(column.in_([])), connection)
+            return pd.concat(frames, ignore_index=True)
+
+    def get_history_count(self, horse_id: int, date) -> int|None:
+        """
+        特定の馬の、開催日がより前の出走結果の件数を取得します。
+        """
+        with self.session() as session:
+            try:
+                return (
+                    session.query(func.count(RaceResult.race_id))
+                    .join(RaceInfo, RaceResult.race_id == RaceInfo.id)
+                    .filter(
+                        RaceResult.horse_id == horse_id,
+                        RaceInfo.date < date
+                    )
+                    .scalar()
+                )
             except Exception as ex:
-                session.rollback()
-                raise ex
+                self.logger.error(ex)
+        return None
 
     def get_speed_figure_last(self, horse_id: int, date) -> float|None:
         assert horse_id > 0
@@ -559,3 +880,151 @@ class SkylarkCrud:
             except Exception as ex:
                 self.logger.error(ex)
         return None
+
+    def seed_crawl_jobs(self, race_ids: list[int]) -> tuple[int, int]:
+        """
+        クロール対象のレースIDを pending として登録します。登録済みのレースIDは状態を維持します。
+        """
+        now = datetime.datetime.now()
+        return self.bulk_insert(CrawlJob, [
+            {"race_id": race_id, "status": "pending", "attempts": 0, "updated_at": now} for race_id in race_ids
+        ])
+
+    def get_retryable_crawl_jobs(self, max_attempts: int) -> dict[int, datetime.datetime|None]:
+        """
+        未完了(stored・rejected以外)かつ試行回数が max_attempts 未満のジョブの {race_id: 次回試行日時} を取得します。
+        """
+        with self.session() as session:
+            try:
+                rows = (
+                    session.query(CrawlJob.race_id, CrawlJob.next_attempt_at)
+                    .filter(
+                        CrawlJob.status.notin_(CRAWL_DONE_STATUSES),
+                        CrawlJob.attempts < max_attempts
+                    )
+                    .all()
+                )
+                return {race_id: next_attempt_at for race_id, next_attempt_at in rows}
+            except Exception as ex:
+                self.logger.error(ex)
+        return {}
+
+    def claim_crawl_jobs(self, worker_id: str, limit: int, lease_seconds: float, max_attempts: int) -> list[int]:
+        """
+        処理可能なジョブを最大 limit 件取得し、lease_seconds 秒のリースを設定します。
+        SELECT ... FOR UPDATE SKIP LOCKED により、複数のワーカーが同じジョブを取得することはありません。
+        リース期限が切れたジョブ(ワーカーの異常終了など)は再度取得対象となります。
+        """
+        with self.session() as session:
+            try:
+                now = datetime.datetime.now()
+                rows = (
+                    session.query(CrawlJob.race_id)
+                    .filter(
+                        CrawlJob.status.notin_(CRAWL_DONE_STATUSES),
+                        CrawlJob.attempts < max_attempts,
+                        or_(CrawlJob.next_attempt_at.is_(None), CrawlJob.next_attempt_at <= now),
+                        or_(CrawlJob.lease_expires_at.is_(None), CrawlJob.lease_expires_at < now)
+                    )
+                    .order_by(CrawlJob.race_id)
+                    .limit(limit)
+                    .with_for_update(skip_locked=True)
+                    .all()
+                )
+                race_ids = [row[0] for row in rows]
+                if len(race_ids) > 0:
+                    session.execute(
+                        update(CrawlJob)
+                        .where(CrawlJob.race_id.in_(race_ids))
+                        .values(
+                            lease_owner=worker_id,
+                            lease_expires_at=now + datetime.timedelta(seconds=lease_seconds),
+                            updated_at=now
+                        )
+                    )
+                session.commit()
+                return race_ids
+
+            except Exception as ex:
+                session.rollback()
+                self.logger.error(ex)
+        return []
+
+    def update_crawl_jobs_status(self, race_ids: list[int], status: str, connection: Connection|None = None) -> None:
+        if len(race_ids) == 0:
+            return
+
+        if connection is None:
+            with self.engine.begin() as connection:
+                return self.update_crawl_jobs_status(race_ids, status, connection=connection)
+
+        for start in range(0, len(race_ids), self.bulk_batch_size):
+            stmt = (
+                update(CrawlJob)
+                .where(CrawlJob.race_id.in_(race_ids[start:start + self.bulk_batch_size]))
+                .values(status=status, updated_at=datetime.datetime.now())
+            )
+            if status == "stored":
+                stmt = stmt.values(last_error=None, next_attempt_at=None, lease_owner=None, lease_expires_at=None)
+            elif status == "pending":
+                stmt = stmt.values(attempts=0, next_attempt_at=None, lease_owner=None, lease_expires_at=None)
+            connection.execute(stmt)
+
+    def fail_crawl_job(self, race_id: int, error: str, backoff: bool = True) -> None:
+        """
+        ジョブを failed とし、指数バックオフ(ジッタ付き)で次回試行日時を設定します。
+        backoff=False の場合は待たずに再試行できるようにします(取得し直せば解決する失敗)。
+        """
+        try:
+            with self.engine.begin() as connection:
+                attempts = connection.execute(
+                    select(CrawlJob.attempts).where(CrawlJob.race_id == race_id).with_for_update()
+                ).scalar_one_or_none()
+                if attempts is None:
+                    return
+
+                attempts = int(attempts) + 1
+                delay = min(self.crawl_retry_max, self.crawl_retry_base * (2 ** (attempts - 1)))
+                delay = random.uniform(delay / 2, delay) if backoff == True else 0.0
+                now = datetime.datetime.now()
+
+                connection.execute(
+                    update(CrawlJob)
+                    .where(CrawlJob.race_id == race_id)
+                    .values(
+                        status="failed",
+                        attempts=attempts,
+                        last_error=error[:4096],
+                        next_attempt_at=now + datetime.timedelta(seconds=delay),
+                        lease_owner=None,
+                        lease_expires_at=None,
+                        updated_at=now
+                    )
+                )
+
+        except Exception as ex:
+            self.logger.error(ex)
+
+    def reject_crawl_job(self, race_id: int, error: str) -> None:
+        """
+        再試行しても結果が変わらない失敗(取得し直したページのパース失敗・データの不正)として、ジョブを rejected にします。
+        rejected のジョブは --force で登録し直すまで再試行しません。
+        """
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    update(CrawlJob)
+                    .where(CrawlJob.race_id == race_id)
+                    .values(
+                        status="rejected",
+                        attempts=func.coalesce(CrawlJob.attempts, 0) + 1,
+                        last_error=error[:4096],
+                        next_attempt_at=None,
+                        lease_owner=None,
+                        lease_expires_at=None,
+                        updated_at=datetime.datetime.now()
+                    )
+                )
+
+        except Exception as ex:
+            self.logger.error(ex)
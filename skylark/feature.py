@@ -5,9 +5,48 @@
 # This software is released under the MIT License.
 #
 
+from collections import deque
+import datetime
+from decimal import Decimal
 import json
+from logging import Logger
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
 from skylark.crud import SkylarkCrud
 
+# 特徴量の定義のバージョン。計算方法・項目を変えた場合は上げると、-F で全ての行を再計算します
+FEATURE_VERSION = 1
+
+# 馬ID・開催日(1970-01-01からの日数)を1つの整数キーにするための日数の幅
+_DAY_SPAN = 1 << 17
+
+def _json_number(value):
+    # MySQL の AVG(整数列) は Decimal を返すため、JSON に書ける float へ変換
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+def build_calculation_result(speed_figure_last, speed_figure_avg, winner_avg, disavesr, distance_avg, earnings_per_share) -> dict:
+    """
+    特徴量を calculation_result_json の形式にします。
+    SkylarkFeature(1行ずつ) と SkylarkFeatureEngine(一括) の両方から使います。
+    """
+    return {
+        "sppeed_figure_last": speed_figure_last,
+        "speed_figure_avg": _json_number(speed_figure_avg),
+        "winner_avg": _json_number(winner_avg),
+        "disavesr": disavesr.as_integer_ratio() if disavesr is not None else None,
+        "distance_avg": distance_avg.as_integer_ratio() if distance_avg is not None else None,
+        "earnings_per_share": _json_number(earnings_per_share)
+    }
+
+def dump_calculation_result(calculation_result: dict) -> str:
+    return json.dumps(calculation_result, ensure_ascii=False, sort_keys=True)
+
 
 class SkylarkFeature():
     def __init__(self, args, logger):
@@ -17,7 +56,10 @@ class SkylarkFeature():
     def __enter__(self):
         return self
 
-    def initialize(self, db_crud: SkylarkCrud, race_id, horse_number):
+    def initialize(self, db_crud: SkylarkCrud, race_id, horse_number, write: bool = True) -> dict|None:
+        """
+        特徴量を計算します。write=False の場合は書き込まずに feature_tbl の行を返します。
+        """
         assert race_id > 0 and horse_number > 0
 
         race_info = db_crud.get_race_info(race_id)
@@ -64,21 +106,382 @@ class SkylarkFeature():
 
         earnings_per_share = db_crud.get_earnings_per_share(horse_id, date, 100)
 
-        calculation_result = {
-            "sppeed_figure_last": speed_figure_last,
-            "speed_figure_avg": speed_figure_avg,
-            "winner_avg": winner_avg,
-            "disavesr": disavesr.as_integer_ratio() if disavesr is not None else None,
-            "distance_avg": distance_avg.as_integer_ratio() if distance_avg is not None else None,
-            "earnings_per_share": earnings_per_share
+        history_count = db_crud.get_history_count(horse_id, date)
+
+        calculation_result = build_calculation_result(
+            speed_figure_last, speed_figure_avg, winner_avg, disavesr, distance_avg, earnings_per_share)
+
+        dataset = {
+            "horse_id": horse_id,
+            "race_id": race_id,
+            "jockey_id": jockey_id,
+            "trainer_id": trainer_id,
+            "calculation_result_json": dump_calculation_result(calculation_result),
+            "feature_version": FEATURE_VERSION,
+            "history_count": history_count,
         }
+        if write == True:
+            db_crud.upsert_features([dataset])
+        return dataset
+
+def _int_values(series: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    # (欠損を0にした値, 欠損でないか)
+    valid = series.notna().to_numpy(dtype=bool)
+    values = series.fillna(0).to_numpy(dtype=np.int64)
+    return values, valid
+
+def _decimal_avgs(sums: np.ndarray, counts: np.ndarray) -> list[Decimal|None]:
+    """
+    MySQL の AVG(整数列) と同じく、小数点以下4桁に四捨五入(0から遠い方へ丸め)した Decimal を返します。
+    """
+    scaled = np.abs(sums) * 10000
+    # 件数0の行は None にするので、ゼロ除算を避ける
+    divisors = np.maximum(counts, 1)
+    quotients = np.sign(sums) * ((scaled * 2 + divisors) // (divisors * 2))
+    return [Decimal(int(quotient)).scaleb(-4) if count > 0 else None for quotient, count in zip(quotients, counts)]
+
+def _decimal_avg(total: int, count: int) -> Decimal|None:
+    # _decimal_avgs の1件版
+    if count == 0:
+        return None
+    quotient = (abs(total) * 10000 * 2 + count) // (count * 2)
+    return Decimal(quotient if total >= 0 else -quotient).scaleb(-4)
+
+class _History:
+    """
+    グループ(馬など)毎・開催日順に並べた過去走から、各行の開催日より前の直近 limit 件の範囲を求めます。
+    """
+    def __init__(self, groups: np.ndarray, days: np.ndarray, mask: np.ndarray, limit: int):
+        keys = groups * _DAY_SPAN + days
+        selected = np.flatnonzero(mask)
+        self.order = selected[np.argsort(keys[selected], kind="stable")]
+        sorted_keys = keys[self.order]
+        # 開催日が同じ行は含めない(DBの実装の date < date)
+        self.end = np.searchsorted(sorted_keys, keys, side="left")
+        self.begin = np.searchsorted(sorted_keys, groups * _DAY_SPAN, side="left")
+        self.start = np.maximum(self.end - limit, self.begin)
+        self.limit = limit
+
+    def counts(self, valid: np.ndarray|None = None) -> np.ndarray:
+        if valid is None:
+            return self.end - self.start
+        cumsum = np.concatenate(([0], np.cumsum(valid[self.order], dtype=np.int64)))
+        return cumsum[self.end] - cumsum[self.start]
+
+    def sums(self, values: np.ndarray) -> np.ndarray:
+        cumsum = np.concatenate(([0], np.cumsum(values[self.order], dtype=np.int64)))
+        return cumsum[self.end] - cumsum[self.start]
 
-        db_crud.upsert_features([
-            {
-                "horse_id": horse_id,
-                "race_id": race_id,
+    def ordered_sums(self, values: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        # 浮動小数点数は累積和の差では誤差が出るため、DBと同じく新しい順に1件ずつ足す
+        values = values[self.order]
+        valid = valid[self.order]
+        result = np.zeros(len(self.end), dtype=np.float64)
+        if len(values) == 0:
+            return result
+        for offset in range(1, self.limit + 1):
+            index = self.end - offset
+            inside = index >= self.start
+            index = np.where(inside, index, 0)
+            result = np.where(inside & valid[index], result + values[index], result)
+        return result
+
+    def previous(self) -> np.ndarray:
+        # limit に関係なく、開催日より前の行の件数
+        return self.end - self.begin
+
+    def last(self, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        values = values[self.order]
+        exists = self.end > self.start
+        if len(values) == 0:
+            return np.zeros(len(self.end), dtype=values.dtype), exists
+        return values[np.where(exists, self.end - 1, 0)], exists
+
+class SkylarkFeatureEngine():
+    """
+    race_result_tbl と race_info_tbl を結合した全行を一度に読み込み、
+    馬毎・開催日順の累積和から SkylarkFeature と同じ特徴量をまとめて計算します。
+    """
+    def __init__(self, logger: Logger, feature_version: int = FEATURE_VERSION):
+        self.logger = logger
+        self.feature_version = feature_version
+
+    def compute(self, frame: pd.DataFrame, states: pd.DataFrame|None = None) -> list[dict]:
+        """
+        frame は race_id, horse_number, horse_id, jockey_id, trainer_id, speed_figure,
+        order_of_finish, earning_money, date, distance の列を持つ DataFrame です(対象の馬の全ての出走結果)。
+        states (feature_tbl の race_id, horse_id, feature_version, history_count) を渡すと、
+        特徴量がない行と古くなった行のみ返します。
+        戻り値は feature_tbl の行のリストです。
+        """
+        frame = frame.reset_index(drop=True)
+        rows = len(frame)
+        if rows == 0:
+            return []
+
+        horse_ids = frame["horse_id"].to_numpy(dtype=np.int64)
+        horses = pd.factorize(horse_ids)[0].astype(np.int64)
+        days = pd.to_datetime(frame["date"]).to_numpy(dtype="datetime64[D]").astype(np.int64)
+
+        speed_figure, has_speed_figure = _int_values(frame["speed_figure"])
+        order_of_finish, has_order_of_finish = _int_values(frame["order_of_finish"])
+        distance, has_distance = _int_values(frame["distance"])
+        # earning_money はMySQLではFLOAT(単精度)なので、AVGと同じく単精度に丸めた値を使う
+        earning_money = frame["earning_money"].astype("float64").fillna(0).to_numpy(dtype=np.float32).astype(np.float64)
+        has_earning_money = frame["earning_money"].notna().to_numpy(dtype=bool)
+
+        # speed_figure があるレースのみ
+        speed = _History(horses, days, has_speed_figure, 5)
+        speed_last, has_speed_last = speed.last(speed_figure)
+
+        # 3着以内かつ speed_figure があるレースのみ
+        winner_mask = has_speed_figure & has_order_of_finish & (order_of_finish >= 1) & (order_of_finish <= 3)
+        winner = _History(horses, days, winner_mask, 5)
+
+        # 同じ距離かつ speed_figure があるレース(馬・距離の組をグループにする)
+        distances, distance_kinds = pd.factorize(distance)
+        same_distance = _History(horses * len(distance_kinds) + distances, days,
+            has_speed_figure & has_distance, 100)
+
+        # 全てのレース(AVG は NULL を除く)
+        recent = _History(horses, days, np.ones(rows, dtype=bool), 100)
+        earning_counts = recent.counts(has_earning_money)
+        earning_sums = recent.ordered_sums(earning_money, has_earning_money)
+        history_counts = recent.previous()
+
+        # 書き込む行(特徴量がない・定義のバージョンが古い・過去走の件数が変わった行)
+        targets = np.arange(rows)
+        if states is not None:
+            merged = frame[["race_id", "horse_id"]].merge(
+                states[["race_id", "horse_id", "feature_version", "history_count"]], on=["race_id", "horse_id"], how="left")
+            stale = (merged["feature_version"].isna().to_numpy(dtype=bool)
+                | (merged["feature_version"].fillna(-1).to_numpy(dtype=np.int64) != self.feature_version)
+                | (merged["history_count"].fillna(-1).to_numpy(dtype=np.int64) != history_counts))
+            targets = np.flatnonzero(stale)
+
+        speed_figure_avgs = _decimal_avgs(speed.sums(speed_figure)[targets], speed.counts()[targets])
+        winner_avgs = _decimal_avgs(winner.sums(order_of_finish)[targets], winner.counts()[targets])
+        disavesrs = _decimal_avgs(same_distance.sums(speed_figure)[targets], same_distance.counts()[targets])
+        distance_avgs = _decimal_avgs(recent.sums(distance)[targets], recent.counts(has_distance)[targets])
+
+        dataset_list = []
+        columns = zip(frame["race_id"].to_numpy(dtype=np.int64)[targets], horse_ids[targets],
+            frame["jockey_id"].to_numpy()[targets].tolist(), frame["trainer_id"].to_numpy()[targets].tolist(),
+            speed_last[targets].tolist(), has_speed_last[targets].tolist(), speed_figure_avgs, winner_avgs,
+            disavesrs, has_distance[targets].tolist(), distance_avgs,
+            earning_sums[targets].tolist(), earning_counts[targets].tolist(), history_counts[targets].tolist())
+        for (race_id, horse_id, jockey_id, trainer_id, last, has_last, speed_figure_avg, winner_avg,
+                disavesr, distance_exists, distance_avg, earning_sum, earning_count, history_count) in columns:
+            calculation_result = build_calculation_result(
+                last if has_last else None,
+                speed_figure_avg,
+                winner_avg,
+                disavesr if distance_exists else None,
+                distance_avg,
+                earning_sum / earning_count if earning_count > 0 else None)
+            dataset_list.append({
+                "horse_id": int(horse_id),
+                "race_id": int(race_id),
                 "jockey_id": jockey_id,
                 "trainer_id": trainer_id,
-                "calculation_result_json": json.dumps(calculation_result, ensure_ascii=False, sort_keys=True),
-            }
-        ])
+                "calculation_result_json": dump_calculation_result(calculation_result),
+                "feature_version": self.feature_version,
+                "history_count": history_count,
+            })
+        return dataset_list
+
+class _Window():
+    """
+    直近 size 件の整数値と、その合計・件数(None を除く)を保持するリングバッファです。
+    """
+    __slots__ = ("values", "total", "count")
+
+    def __init__(self, size: int):
+        self.values: deque = deque(maxlen=size)
+        self.total: int = 0
+        self.count: int = 0
+
+    def append(self, value: int|None) -> None:
+        # 一杯の場合は、追加で押し出される最も古い値を合計から除く
+        if len(self.values) == self.values.maxlen:
+            oldest = self.values[0]
+            if oldest is not None:
+                self.total -= oldest
+                self.count -= 1
+        self.values.append(value)
+        if value is not None:
+            self.total += value
+            self.count += 1
+
+    def average(self) -> Decimal|None:
+        return _decimal_avg(self.total, self.count)
+
+class _HorseState():
+    """
+    馬毎の、処理済みの出走結果から作った状態です。
+    """
+    __slots__ = ("history_count", "speed_figures", "winners", "distance_speed_figures", "distances", "earnings")
+
+    def __init__(self):
+        self.history_count: int = 0
+        # speed_figure がある直近5走の speed_figure
+        self.speed_figures = _Window(5)
+        # 3着以内かつ speed_figure がある直近5走の着順
+        self.winners = _Window(5)
+        # 距離毎の、speed_figure がある直近100走の speed_figure
+        self.distance_speed_figures: dict[int, _Window] = {}
+        # 直近100走の距離・賞金
+        self.distances = _Window(100)
+        self.earnings: deque = deque(maxlen=100)
+
+    def calculation_result(self, distance: int|None) -> dict:
+        disavesr = None
+        if distance is not None:
+            window = self.distance_speed_figures.get(distance)
+            disavesr = window.average() if window is not None else None
+
+        # 浮動小数点数の合計は誤差が出るため、DBの AVG と同じく新しい順に1件ずつ足す
+        earning_sum = 0.0
+        earning_count = 0
+        for earning in reversed(self.earnings):
+            if earning is not None:
+                earning_sum += earning
+                earning_count += 1
+
+        speed_figures = self.speed_figures.values
+        return build_calculation_result(
+            speed_figures[-1] if len(speed_figures) > 0 else None,
+            self.speed_figures.average(),
+            self.winners.average(),
+            disavesr,
+            self.distances.average(),
+            earning_sum / earning_count if earning_count > 0 else None)
+
+    def fold(self, row) -> None:
+        self.history_count += 1
+        if row.speed_figure is not None:
+            self.speed_figures.append(row.speed_figure)
+            if row.order_of_finish is not None and 1 <= row.order_of_finish <= 3:
+                self.winners.append(row.order_of_finish)
+            if row.distance is not None:
+                self.distance_speed_figures.setdefault(row.distance, _Window(100)).append(row.speed_figure)
+        self.distances.append(row.distance)
+        # earning_money はMySQLではFLOAT(単精度)なので、AVGと同じく単精度に丸めた値を使う
+        self.earnings.append(float(np.float32(row.earning_money)) if row.earning_money is not None else None)
+
+class SkylarkFeatureStream():
+    """
+    出走結果を開催日順に1度だけ読み込み、馬毎の状態(直近の出走結果のリングバッファ)から特徴量を計算します。
+    各開催日の特徴量はその日の結果を状態に加える前に計算するため、当日以降の結果は含みません。
+    状態は snapshot_path に保存し、次回は保存した開催日より後のレースのみ処理します。
+    """
+    def __init__(self, snapshot_path: str, logger: Logger, feature_version: int = FEATURE_VERSION, batch_size: int|None = None):
+        self.snapshot_path = snapshot_path
+        self.logger = logger
+        self.feature_version = feature_version
+        if batch_size is None:
+            batch_size = int(os.getenv("FEATURE_STREAM_BATCH_SIZE", "10000"))
+        self.batch_size: int = max(1, batch_size)
+        self.reset()
+
+    def reset(self) -> None:
+        self.horses: dict[int, _HorseState] = {}
+        # 処理済みの最後の開催日と、それまでの出走結果の件数
+        self.date: datetime.date|None = None
+        self.rows: int = 0
+
+    def remove_snapshot(self) -> None:
+        self.reset()
+        if os.path.isfile(self.snapshot_path):
+            os.remove(self.snapshot_path)
+
+    def load_snapshot(self, db_crud: SkylarkCrud) -> bool:
+        """
+        保存した状態を読み込みます。特徴量の定義のバージョンが違う場合や、
+        保存した開催日以前の出走結果が増減している(過去のレースを後から取り込んだ)場合は最初から処理します。
+        """
+        self.reset()
+        if os.path.isfile(self.snapshot_path) == False:
+            return False
+
+        with open(self.snapshot_path, "rb") as file:
+            snapshot = pickle.load(file)
+
+        if snapshot["feature_version"] != self.feature_version:
+            self.logger.info("feature version changed: %d -> %d, replay all races", snapshot["feature_version"], self.feature_version)
+            return False
+        rows = db_crud.count_race_results(snapshot["date"])
+        if rows != snapshot["rows"]:
+            self.logger.info("race results until %s changed: %d -> %d, replay all races", snapshot["date"], snapshot["rows"], rows)
+            return False
+
+        self.horses = snapshot["horses"]
+        self.date = snapshot["date"]
+        self.rows = snapshot["rows"]
+        self.logger.info("resume from %s (%d horses, %d race results)", self.date, len(self.horses), self.rows)
+        return True
+
+    def save_snapshot(self) -> None:
+        if self.date is None:
+            return
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        snapshot = {
+            "feature_version": self.feature_version,
+            "date": self.date,
+            "rows": self.rows,
+            "horses": self.horses,
+        }
+        with open(self.snapshot_path + ".tmp", "wb") as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+
+    def run(self, db_crud: SkylarkCrud) -> int:
+        """
+        保存した開催日より後のレースの特徴量を計算して feature_tbl に書き込み、状態を保存します。
+        戻り値は書き込んだ行数です。
+        """
+        self.load_snapshot(db_crud)
+
+        written = 0
+        dataset_list: list[dict] = []
+        day_rows: list = []
+        for row in db_crud.iter_feature_source(date_after=self.date):
+            if len(day_rows) > 0 and row.date != day_rows[0].date:
+                dataset_list.extend(self._process_day(day_rows))
+                day_rows = []
+                if len(dataset_list) >= self.batch_size:
+                    written += db_crud.bulk_upsert_features(dataset_list)[0]
+                    dataset_list = []
+            day_rows.append(row)
+
+        if len(day_rows) > 0:
+            dataset_list.extend(self._process_day(day_rows))
+        written += db_crud.bulk_upsert_features(dataset_list)[0]
+
+        # 全て書き込んでから状態を保存(途中で失敗した場合は前回の状態からやり直す)
+        self.save_snapshot()
+        return written
+
+    def _process_day(self, rows: list) -> list[dict]:
+        # 同じ開催日の結果を加える前に、全ての行の特徴量を計算
+        dataset_list = []
+        for row in rows:
+            state = self.horses.get(row.horse_id)
+            if state is None:
+                state = self.horses[row.horse_id] = _HorseState()
+            dataset_list.append({
+                "horse_id": row.horse_id,
+                "race_id": row.race_id,
+                "jockey_id": row.jockey_id,
+                "trainer_id": row.trainer_id,
+                "calculation_result_json": dump_calculation_result(state.calculation_result(row.distance)),
+                "feature_version": self.feature_version,
+                "history_count": state.history_count,
+            })
+
+        for row in rows:
+            self.horses[row.horse_id].fold(row)
+
+        self.date = rows[0].date
+        self.rows += len(rows)
+        return dataset_list
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import glob
+from logging import Logger
+import os
+import threading
+import time
+from typing import Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from skylark.parser import PARSER_VERSION
+from skylark.util import SkylarkUtil
+
+# パース結果のテーブル毎のスキーマ
+_SCHEMAS: dict[str, pa.Schema] = {
+    "race_info": pa.schema([
+        ("id", pa.int64()),
+        ("race_name", pa.string()),
+        ("distance", pa.int64()),
+        ("weather", pa.string()),
+        ("post_time", pa.string()),
+        ("race_number", pa.int64()),
+        ("run_direction", pa.string()),
+        ("track_surface", pa.string()),
+        ("track_condition", pa.string()),
+        ("track_condition_score", pa.int64()),
+        ("date", pa.date32()),
+        ("place_detail", pa.string()),
+        ("race_grade", pa.int64()),
+        ("race_class", pa.string()),
+        ("parser_version", pa.int64()),
+    ]),
+    # race_result に馬・騎手・調教師・馬主の名前を加えたもの
+    "entry": pa.schema([
+        ("race_id", pa.int64()),
+        ("horse_number", pa.int64()),
+        ("order_of_finish", pa.int64()),
+        ("bracket_number", pa.int64()),
+        ("horse_id", pa.int64()),
+        ("sex", pa.string()),
+        ("age", pa.int64()),
+        ("basis_weight", pa.float64()),
+        ("jockey_id", pa.string()),
+        ("finishing_time", pa.string()),
+        ("margin", pa.string()),
+        ("speed_figure", pa.int64()),
+        ("passing_rank", pa.string()),
+        ("last_phase", pa.float64()),
+        ("odds", pa.float64()),
+        ("popularity", pa.int64()),
+        ("horse_weight", pa.int64()),
+        ("horse_weight_diff", pa.int64()),
+        ("remark", pa.string()),
+        ("stable", pa.string()),
+        ("trainer_id", pa.string()),
+        ("owner_id", pa.string()),
+        ("earning_money", pa.float64()),
+        ("horse_name", pa.string()),
+        ("jockey_name", pa.string()),
+        ("trainer_name", pa.string()),
+        ("owner_name", pa.string()),
+    ]),
+    "payoff": pa.schema([
+        ("race_id", pa.int64()),
+        ("ticket_type", pa.int64()),
+        ("horse_numbers", pa.string()),
+        ("payoff", pa.int64()),
+        ("popularity", pa.int64()),
+    ]),
+}
+
+# entry のうち race_result_tbl の列
+_RESULT_COLUMNS = tuple(name for name in _SCHEMAS["entry"].names
+    if name not in ("horse_name", "jockey_name", "trainer_name", "owner_name"))
+
+def _to_int(value) -> int|None:
+    return int(value) if value is not None else None
+
+class SkylarkParsedStore:
+    """
+    パース済みレースを、パーサーのバージョン・開催年毎に分割したParquetファイルに格納します。
+    <directory>/v<parser_version>/<table>/year=<YYYY>/part-*.parquet
+    同じレースが複数のファイルにある場合は、後から書き込んだファイルのものが有効です。
+    """
+    def __init__(self, directory: str, logger: Logger, parser_version: int = PARSER_VERSION, batch_size: int|None = None):
+        self.directory = directory
+        self.logger = logger
+        self.parser_version = parser_version
+        if batch_size is None:
+            batch_size = int(os.getenv("PARSED_STORE_BATCH_SIZE", "1000"))
+        self.batch_size: int = max(1, batch_size)
+
+        self.lock = threading.Lock()
+        # テーブル -> 開催年 -> 行
+        self.pending: dict[str, dict[int, list[dict]]] = {name: {} for name in _SCHEMAS}
+        self.pending_races: int = 0
+        self.written_races: int = 0
+        self.sequence: int = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def version_dir(self) -> str:
+        return os.path.join(self.directory, f"v{self.parser_version}")
+
+    def add(self, record: dict) -> bool:
+        """
+        パース済みレース(parse_race の戻り値)を追加します。スキーマに合わない値を含むレースは追加しません。
+        """
+        race_id = record["race_info"]["id"]
+        try:
+            race_info = dict(record["race_info"])
+            race_info["date"] = SkylarkUtil.convertToDate(race_info["date"])
+            if race_info["date"] is None:
+                raise ValueError("invalid date")
+            race_info.setdefault("parser_version", self.parser_version)
+
+            entries = []
+            names = zip(record["horses"], record["jockeys"], record["trainers"], record["owners"])
+            for result, (horse, jockey, trainer, owner) in zip(record["race_results"], names):
+                entry = dict(result)
+                entry["horse_weight"] = _to_int(entry["horse_weight"])
+                entry["horse_weight_diff"] = _to_int(entry["horse_weight_diff"])
+                entry["horse_name"] = horse["horse_name"]
+                entry["jockey_name"] = jockey["jockey_name"]
+                entry["trainer_name"] = trainer["trainer_name"]
+                entry["owner_name"] = owner["owner_name"]
+                entries.append(entry)
+
+            # 変換できない値がないか、追加する前に確認
+            rows = {"race_info": [race_info], "entry": entries, "payoff": record["payoffs"]}
+            for name, table_rows in rows.items():
+                pa.Table.from_pylist(table_rows, schema=_SCHEMAS[name])
+        except (ValueError, TypeError, KeyError, pa.ArrowException) as ex:
+            self.logger.warning("race_id: %d, not stored in parsed store: %s", race_id, ex)
+            return False
+
+        # レースIDの先頭4桁は開催年
+        year = race_id // 100000000
+        with self.lock:
+            for name, table_rows in rows.items():
+                self.pending[name].setdefault(year, []).extend(table_rows)
+            self.pending_races += 1
+            if self.pending_races < self.batch_size:
+                return True
+            pending = self._take_pending()
+        self._write(pending)
+        return True
+
+    def flush(self) -> None:
+        with self.lock:
+            pending = self._take_pending()
+        self._write(pending)
+
+    def _take_pending(self) -> dict[str, dict[int, list[dict]]]:
+        pending = self.pending
+        self.pending = {name: {} for name in _SCHEMAS}
+        self.written_races += self.pending_races
+        self.pending_races = 0
+        return pending
+
+    def _write(self, pending: dict[str, dict[int, list[dict]]]) -> None:
+        for name, years in pending.items():
+            for year, rows in years.items():
+                if len(rows) == 0:
+                    continue
+                partition_dir = os.path.join(self.version_dir(), name, f"year={year}")
+                os.makedirs(partition_dir, exist_ok=True)
+
+                with self.lock:
+                    self.sequence += 1
+                    sequence = self.sequence
+                # ファイル名の順が書き込み順になるようにする
+                filename = f"part-{time.time_ns():020d}-{os.getpid()}-{sequence:06d}.parquet"
+                path = os.path.join(partition_dir, filename)
+                table = pa.Table.from_pylist(rows, schema=_SCHEMAS[name])
+                pq.write_table(table, path + ".tmp", compression="zstd")
+                os.replace(path + ".tmp", path)
+
+    def years(self) -> list[int]:
+        paths = glob.glob(os.path.join(self.version_dir(), "race_info", "year=*"))
+        return sorted(int(os.path.basename(path).split("=", 1)[1]) for path in paths)
+
+    def read_table(self, name: str, year_from: int|None = None, year_to: int|None = None) -> pd.DataFrame:
+        """
+        テーブルを読み込みます。同じレースが複数のファイルにある場合は、最後に書き込んだファイルの行のみ返します。
+        """
+        frames = []
+        for year in self.years():
+            if (year_from is not None and year < year_from) or (year_to is not None and year > year_to):
+                continue
+            paths = sorted(glob.glob(os.path.join(self.version_dir(), name, f"year={year}", "*.parquet")))
+            for part, path in enumerate(paths):
+                frame = pq.read_table(path, schema=_SCHEMAS[name]).to_pandas(types_mapper=pd.ArrowDtype)
+                frame["_part"] = part
+                frames.append(frame)
+
+        if len(frames) == 0:
+            return pd.DataFrame({field.name: pd.Series(dtype=pd.ArrowDtype(field.type)) for field in _SCHEMAS[name]})
+
+        frame = pd.concat(frames, ignore_index=True)
+        key = "id" if name == "race_info" else "race_id"
+        latest = frame.groupby(key)["_part"].transform("max")
+        return frame[frame["_part"] == latest].drop(columns="_part").reset_index(drop=True)
+
+    def iter_records(self, year_from: int|None = None, year_to: int|None = None) -> Iterator[dict]:
+        """
+        格納したレースを、パース直後と同じ形式(SkylarkCrud.store_races に渡す形式)で返します。
+        """
+        for year in self.years():
+            if (year_from is not None and year < year_from) or (year_to is not None and year > year_to):
+                continue
+
+            race_infos = self.read_table("race_info", year, year)
+            entries = self.read_table("entry", year, year)
+            payoffs = self.read_table("payoff", year, year)
+
+            entries_by_race = {race_id: frame for race_id, frame in entries.groupby("race_id")}
+            payoffs_by_race = {race_id: frame for race_id, frame in payoffs.groupby("race_id")}
+            empty_entries = entries.iloc[0:0]
+            empty_payoffs = payoffs.iloc[0:0]
+
+            for race_info in _to_rows(race_infos):
+                race_id = race_info["id"]
+                race_entries = _to_rows(entries_by_race.get(race_id, empty_entries))
+                yield {
+                    "race_info":race_info,
+                    "horses":[{"id":entry["horse_id"], "horse_name":entry["horse_name"]} for entry in race_entries],
+                    "jockeys":[{"id":entry["jockey_id"], "jockey_name":entry["jockey_name"]} for entry in race_entries],
+                    "trainers":[{"id":entry["trainer_id"], "trainer_name":entry["trainer_name"]} for entry in race_entries],
+                    "owners":[{"id":entry["owner_id"], "owner_name":entry["owner_name"]} for entry in race_entries],
+                    "race_results":[{name: entry[name] for name in _RESULT_COLUMNS} for entry in race_entries],
+                    "payoffs":_to_rows(payoffs_by_race.get(race_id, empty_payoffs))
+                }
+
+    def read_race_results(self, year_from: int|None = None, year_to: int|None = None) -> pd.DataFrame:
+        """
+        特徴量の計算用に、出走結果へ開催日・距離を結合して返します(MySQLを経由しない)。
+        """
+        race_infos = self.read_table("race_info", year_from, year_to)[["id", "date", "distance"]]
+        entries = self.read_table("entry", year_from, year_to)
+        return entries.merge(race_infos.rename(columns={"id": "race_id"}), on="race_id", how="inner")
+
+# DataFrame を dict のリストへ変換(欠損値は None)
+def _to_rows(frame: pd.DataFrame) -> list[dict]:
+    return pa.Table.from_pandas(frame, preserve_index=False).to_pylist()
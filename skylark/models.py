@@ -6,7 +6,7 @@
 #
 
 from sqlalchemy import (
-    JSON, Column, Integer, BigInteger, String, Float, Text, Time, Date,
+    JSON, Column, Integer, BigInteger, String, Float, Text, Time, Date, DateTime,
     ForeignKey, Index
 )
 from sqlalchemy.ext.declarative import declarative_base
@@ -30,11 +30,14 @@ class RaceInfo(Base):
     place_detail = Column(String(16), nullable=False)
     race_grade = Column(Integer, nullable=True)
     race_class = Column(String(64), nullable=True)
+    # レースを取り込んだパーサーのバージョン(skylark.parser.PARSER_VERSION)
+    parser_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     # インデックス
     __table_args__ = (
         Index('idx_race_name', 'race_name'),
         Index('idx_date_post_time', 'date', 'post_time'),
+        Index('idx_parser_version', 'parser_version'),
     )
 
 class Horse(Base):
@@ -106,3 +109,25 @@ class Feature(Base):
     jockey_id = Column(String(32), nullable=False)
     trainer_id = Column(String(32), nullable=False)
     calculation_result_json = Column(JSON, nullable=True)
+    # 計算した特徴量の定義のバージョン(skylark.feature.FEATURE_VERSION)
+    feature_version = Column(Integer, nullable=False, default=0, server_default="0")
+    # 計算時点での、この馬の開催日がより前の出走結果の件数(増えていれば再計算する)
+    history_count = Column(Integer, nullable=True)
+
+class CrawlJob(Base):
+    __tablename__ = 'crawl_job_tbl'
+    race_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    # pending, fetched, parsed, stored, failed, rejected(再試行しない失敗)
+    status = Column(String(16), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime, nullable=True)
+    # 複数ワーカーで処理する場合の取得者と期限(期限切れのジョブは他のワーカーが再取得する)
+    lease_owner = Column(String(64), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+    # インデックス
+    __table_args__ = (
+        Index('idx_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
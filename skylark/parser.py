@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from html import escape
+from logging import Logger
+import re
+
+from cssselect import HTMLTranslator
+from lxml import etree
+from pyquery import PyQuery as pq
+from pyquery.text import INLINE_TAGS, extract_text
+
+from skylark.util import SkylarkUtil
+
+# パース結果が変わる修正をした場合に上げる。古いバージョンで取り込んだレースは --reparse で再パースする
+PARSER_VERSION = 1
+
+# pyqueryと同じCSSセレクタ -> XPath 変換を、モジュール読み込み時に一度だけコンパイル
+def _compile(selector: str) -> etree.XPath:
+    return etree.XPath(HTMLTranslator().css_to_xpath(selector, prefix="descendant-or-self::"))
+
+_XPATH_RACE_HEAD = _compile("html body div#page div#main div.race_head")
+_XPATH_RACE_NUMBER = _compile("dl.racedata dt")
+_XPATH_RACE_NAME = _compile("dl.racedata dd h1")
+_XPATH_RACE_DATA = _compile("dl.racedata dd p span")
+_XPATH_RACE_DETAIL = _compile("div.mainrace_data p")
+_XPATH_RESULT_ROWS = _compile("html body div#page div#contents_liquid table tr")
+_XPATH_PAY_ROWS = _compile("html body div#page div#contents dl.pay_block tr")
+
+_RE_RACE_DATA = re.compile(r'^([^\d ]+).*?(\d{4})m\s*/\s*天候 : (\w+)\s*/\s*(.+)\s+/\s+発走 : (\d{1,2}:\d{1,2})', re.U)
+_RE_TRACK_CONDITION = re.compile(r'^.*?\s*:\s*(\w+)\s*', re.U)
+_RE_RACE_DETAIL = re.compile(r'^(\d{4})年\s*(\d{1,2})月\s*(\d{1,2})日\s*(\S+?)(?:\s+(.+))?$')
+_RE_LEFT = re.compile(r'^.*左')
+_RE_RIGHT = re.compile(r'^.*右')
+_RE_STRAIGHT = re.compile(r'^.*直線')
+_RE_OUTER = re.compile(r'^.*外$')
+_RE_SEX_AGE = re.compile(r'^(.)(\d+)$')
+_RE_FINISHING_TIME = re.compile(r'^(\d+:\d+\.\d+)$')
+_RE_HORSE_WEIGHT = re.compile(r'^(\d+)\(\+?(\-?\d+)\)$')
+_RE_STABLE = re.compile(r'\[(.)\]')
+_RE_BR = re.compile(r"<br\s*/?>")
+
+# lxml.html のHtmlElementは要素毎にクラスの検索が入るため、素の要素を返すパーサーを使う
+_HTML_PARSER = etree.HTMLParser()
+
+# pyquery の text() と同じ空白の定義
+_RE_WHITESPACE = re.compile('[\x20\x09\x0C\u200B\x0A\x0D]+')
+_INLINE_TAGS = frozenset(INLINE_TAGS) - {"br"}
+
+def _text(element) -> str:
+    if len(element) == 0:
+        return _RE_WHITESPACE.sub(" ", element.text or "").strip()
+    # 子孫がインライン要素のみであれば、ブロック・改行の扱いが不要なため連結するだけでよい
+    for child in element.iterdescendants():
+        if not isinstance(child.tag, str) or child.tag not in _INLINE_TAGS:
+            return extract_text(element)
+    return _RE_WHITESPACE.sub(" ", "".join(element.itertext())).strip()
+
+def _texts(elements: list) -> str:
+    return " ".join(_text(element) for element in elements)
+
+def _cell_text(cells: list, index: int) -> str:
+    return _text(cells[index]) if index < len(cells) else ""
+
+# セル内の最初のリンクの (href, テキスト)
+def _cell_link(cells: list, index: int) -> tuple[str|None, str]:
+    if index < len(cells):
+        for link in cells[index].iterdescendants("a"):
+            return link.get("href"), _text(link)
+    return None, ""
+
+# <br> 区切りのセルを行に分割(pyquery の html() を <br> で分割した結果と同じ)
+def _cell_lines(cells: list, index: int) -> list[str]:
+    if index >= len(cells):
+        return ["None"]
+    cell = cells[index]
+    children = cell.getchildren()
+    if any(child.tag != "br" for child in children):
+        return _RE_BR.split(str(pq(cell).html()))
+    return [escape(cell.text or "", quote=False)] + [escape(child.tail or "", quote=False) for child in children]
+
+def _id_of(href: str|None) -> str:
+    return str(href).rsplit("/", 2)[1]
+
+class SkylarkRaceInfo:
+    __slots__ = ("id", "race_name", "distance", "weather", "post_time", "race_number", "run_direction",
+                 "track_surface", "track_condition", "track_condition_score", "date", "place_detail",
+                 "race_grade", "race_class")
+
+    def __init__(self, race_id: int):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.id = race_id
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class SkylarkRaceEntry:
+    # race_result_tbl の列
+    result_fields = ("race_id", "horse_number", "order_of_finish", "bracket_number", "horse_id", "sex", "age",
+                     "basis_weight", "jockey_id", "finishing_time", "margin", "speed_figure", "passing_rank",
+                     "last_phase", "odds", "popularity", "horse_weight", "horse_weight_diff", "remark", "stable",
+                     "trainer_id", "owner_id", "earning_money")
+    __slots__ = result_fields + ("horse_name", "jockey_name", "trainer_name", "owner_name")
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.result_fields}
+
+class SkylarkPayoff:
+    __slots__ = ("race_id", "ticket_type", "horse_numbers", "payoff", "popularity")
+
+    def __init__(self, race_id: int, ticket_type: int, horse_numbers: str, payoff: int, popularity: int):
+        self.race_id = race_id
+        self.ticket_type = ticket_type
+        self.horse_numbers = horse_numbers
+        self.payoff = payoff
+        self.popularity = popularity
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class SkylarkRacePage:
+    __slots__ = ("race_info", "entries", "payoffs")
+
+    def __init__(self, race_info: SkylarkRaceInfo, entries: list[SkylarkRaceEntry], payoffs: list[SkylarkPayoff]):
+        self.race_info = race_info
+        self.entries = entries
+        self.payoffs = payoffs
+
+    # 書き込み用のレコード(scraper.parse_race_html と同じ形式に、パーサーのバージョンを加えたもの)
+    def to_record(self) -> dict:
+        race_info = self.race_info.as_dict()
+        race_info["parser_version"] = PARSER_VERSION
+        return {
+            "race_info":race_info,
+            "horses":[{"id":entry.horse_id, "horse_name":entry.horse_name} for entry in self.entries],
+            "jockeys":[{"id":entry.jockey_id, "jockey_name":entry.jockey_name} for entry in self.entries],
+            "trainers":[{"id":entry.trainer_id, "trainer_name":entry.trainer_name} for entry in self.entries],
+            "owners":[{"id":entry.owner_id, "owner_name":entry.owner_name} for entry in self.entries],
+            "race_results":[entry.as_dict() for entry in self.entries],
+            "payoffs":[payoff.as_dict() for payoff in self.payoffs]
+        }
+
+# lxmlのツリーを1度だけ走査してレースページをパース
+def parse_race_page(race_id: int, html: str, logger: Logger) -> SkylarkRacePage|None:
+    try:
+        dom = etree.fromstring(html, _HTML_PARSER)
+        race_info = SkylarkRaceInfo(race_id)
+
+        race_heads = _XPATH_RACE_HEAD(dom)
+        def race_head(xpath: etree.XPath) -> list:
+            return [element for head in race_heads for element in xpath(head)]
+
+        race_number_text = _texts(race_head(_XPATH_RACE_NUMBER))
+        if race_number_text:
+            race_info.race_number = int(race_number_text.split(" ", 1)[0])
+
+        race_info.race_name = _texts(race_head(_XPATH_RACE_NAME))
+
+        # track_surface, distance, weather, track_condition, post_time
+        matchese: re.Match|None = _RE_RACE_DATA.match(_texts(race_head(_XPATH_RACE_DATA)))
+        if matchese:
+            track_surface_org = matchese.group(1)
+            if track_surface_org.startswith("芝"):
+                race_info.track_surface = "芝"
+            elif track_surface_org.startswith("ダ"):
+                race_info.track_surface = "ダート"
+            elif track_surface_org.startswith("障"):
+                race_info.track_surface = "障害"
+
+            if _RE_LEFT.search(track_surface_org):
+                race_info.run_direction = "左"
+            elif _RE_RIGHT.search(track_surface_org):
+                race_info.run_direction = "右"
+            elif _RE_STRAIGHT.search(track_surface_org):
+                race_info.run_direction = "直線"
+
+            if race_info.run_direction is not None and _RE_OUTER.search(track_surface_org):
+                race_info.run_direction = race_info.run_direction + " 外"
+
+            race_info.distance = int(matchese.group(2))
+            race_info.weather = matchese.group(3)
+
+            matchese_condition = _RE_TRACK_CONDITION.match(matchese.group(4))
+            if matchese_condition:
+                race_info.track_condition = matchese_condition.group(1)
+
+            race_info.post_time = matchese.group(5)
+
+        # date, place_detail, class
+        details = race_head(_XPATH_RACE_DETAIL)
+        text_value = (_text(details[1]) if len(details) > 1 else "").replace('\u00A0', ' ').strip()
+        matchese = _RE_RACE_DETAIL.match(text_value)
+        if matchese:
+            race_info.date = matchese.group(1) + "-" + matchese.group(2) + "-" + matchese.group(3)
+            race_info.place_detail = matchese.group(4)
+            race_info.race_class = matchese.group(5)
+        race_info.race_grade = SkylarkUtil.convertToClass2Int(race_info.race_class)
+
+        entries: list[SkylarkRaceEntry] = []
+        for row in _XPATH_RESULT_ROWS(dom)[1:]:
+            cells = list(row.iterdescendants("td"))
+            entry = SkylarkRaceEntry()
+            entry.race_id = race_id
+
+            #着順
+            try:
+                entry.order_of_finish = int(_cell_text(cells, 0))
+            except ValueError:
+                entry.order_of_finish = None
+
+            #枠番
+            bracket_number = _cell_text(cells, 1)
+            try:
+                bracket_number = int(bracket_number)
+            except ValueError as ex:
+                logger.warning(ex)
+            entry.bracket_number = bracket_number
+
+            #馬番
+            horse_number = _cell_text(cells, 2)
+            try:
+                horse_number = int(horse_number)
+            except ValueError as ex:
+                logger.warning(ex)
+            entry.horse_number = horse_number
+
+            #馬ID, 馬名
+            href, entry.horse_name = _cell_link(cells, 3)
+            horse_id = _id_of(href)
+            try:
+                horse_id = int(horse_id)
+            except ValueError as ex:
+                logger.warning(ex)
+            entry.horse_id = horse_id
+
+            #性別、年齢
+            entry.sex = None
+            entry.age = 0
+            matchese = _RE_SEX_AGE.match(_cell_text(cells, 4))
+            if matchese:
+                entry.sex = matchese.group(1)
+                entry.age = int(matchese.group(2))
+
+            #斤量
+            entry.basis_weight = float(_cell_text(cells, 5))
+
+            #騎手
+            href, entry.jockey_name = _cell_link(cells, 6)
+            entry.jockey_id = _id_of(href)
+
+            #タイム
+            entry.finishing_time = None
+            matchese = _RE_FINISHING_TIME.match(_cell_text(cells, 7))
+            if matchese:
+                entry.finishing_time = '00:' + matchese.group(1)
+
+            #着差
+            entry.margin = _cell_text(cells, 8)
+
+            #タイム指数(有料)
+            try:
+                entry.speed_figure = int(_cell_text(cells, 9))
+            except ValueError:
+                entry.speed_figure = None
+
+            #通過
+            entry.passing_rank = _cell_text(cells, 10)
+
+            #上りタイム
+            try:
+                entry.last_phase = float(_cell_text(cells, 11))
+            except ValueError:
+                entry.last_phase = None
+
+            #単勝オッズ
+            try:
+                entry.odds = float(_cell_text(cells, 12))
+            except ValueError:
+                entry.odds = None
+
+            #人気
+            try:
+                entry.popularity = int(_cell_text(cells, 13))
+            except ValueError:
+                entry.popularity = None
+
+            #馬体重
+            entry.horse_weight = None
+            entry.horse_weight_diff = None
+            matchese = _RE_HORSE_WEIGHT.match(_cell_text(cells, 14))
+            if matchese:
+                entry.horse_weight = matchese.group(1)
+                entry.horse_weight_diff = matchese.group(2)
+
+            #備考
+            entry.remark = _cell_text(cells, 17) or None
+
+            # 厩舎
+            entry.stable = '不明'
+            matchese = _RE_STABLE.match(_cell_text(cells, 18))
+            if matchese:
+                entry.stable = matchese.group(1)
+
+            #調教師
+            href, entry.trainer_name = _cell_link(cells, 18)
+            entry.trainer_id = _id_of(href)
+
+            #馬主
+            href, entry.owner_name = _cell_link(cells, 19)
+            entry.owner_id = _id_of(href)
+
+            #賞金
+            try:
+                entry.earning_money = float(_cell_text(cells, 20).replace(",", ""))
+            except ValueError:
+                entry.earning_money = 0
+
+            entries.append(entry)
+
+        payoffs: list[SkylarkPayoff] = []
+        for row in _XPATH_PAY_ROWS(dom):
+            headers = list(row.iterdescendants("th"))
+            ticket_type_text = _cell_text(headers, 0)
+            ticket_type = SkylarkUtil.convertToTicketType2Int(ticket_type_text)
+            if ticket_type is None:
+                logger.warning("Unknown ticket type, skip: %s", ticket_type_text)
+                continue
+
+            cells = list(row.iterdescendants("td"))
+            horse_numbers_list = _cell_lines(cells, 0)
+            payoff_list = _cell_lines(cells, 1)
+            popularity_list = _cell_lines(cells, 2)
+
+            for idx, horse_numbers in enumerate(horse_numbers_list):
+                payoffs.append(SkylarkPayoff(
+                    race_id,
+                    ticket_type,
+                    horse_numbers.replace(" ", "").replace("→", "->"),
+                    int(payoff_list[idx].replace(",", "")),
+                    int(popularity_list[idx])))
+
+        return SkylarkRacePage(race_info, entries, payoffs)
+    except Exception as ex:
+        logger.error(ex)
+    return None
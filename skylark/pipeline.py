@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import asyncio
+from logging import Logger
+import time
+
+class SkylarkStageStats:
+    """
+    パイプラインの各ステージ(fetch/parse/write)の処理件数と入力キューの深さを集計します。
+    """
+    def __init__(self, name: str, queue: asyncio.Queue|None = None):
+        self.name = name
+        self.queue = queue
+        self.processed: int = 0
+        self.failed: int = 0
+        self.started_at: float = time.monotonic()
+
+    def done(self, failed: bool = False) -> None:
+        if failed:
+            self.failed += 1
+        else:
+            self.processed += 1
+
+    def throughput(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def report(self, logger: Logger) -> None:
+        if self.queue is not None:
+            logger.info("[%s] queue %d/%d, done %d, failed %d, %.2f/s",
+                self.name, self.queue.qsize(), self.queue.maxsize, self.processed, self.failed, self.throughput())
+        else:
+            logger.info("[%s] done %d, failed %d, %.2f/s",
+                self.name, self.processed, self.failed, self.throughput())
+
+async def report_periodically(stats_list: list[SkylarkStageStats], logger: Logger, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        for stats in stats_list:
+            stats.report(logger)
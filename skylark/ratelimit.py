@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+import asyncio
+import datetime
+from email.utils import parsedate_to_datetime
+import time
+
+class _HostBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate: float = rate
+        self.tokens: float = burst
+        self.updated_at: float = time.monotonic()
+        self.blocked_until: float = 0.0
+        self.lock: asyncio.Lock|None = None
+        self.loop: asyncio.AbstractEventLoop|None = None
+
+class SkylarkRateLimiter:
+    """
+    ホスト毎のトークンバケットによるリクエスト間隔の制御です。
+    成功する度に rate_increase ずつ目標レートまで上げ、429/5xx/タイムアウトでは rate_decrease 倍に下げます(AIMD)。
+    Retry-After が返された場合は、その時刻までそのホストへのリクエストを止めます。
+    """
+    def __init__(self, rate: float, burst: float = 1.0, min_rate: float = 0.1,
+                 rate_increase: float = 0.1, rate_decrease: float = 0.5):
+        self.target_rate: float = rate
+        self.burst: float = max(1.0, burst)
+        self.min_rate: float = min(min_rate, rate)
+        self.rate_increase: float = rate_increase
+        self.rate_decrease: float = rate_decrease
+        self.buckets: dict[str, _HostBucket] = {}
+
+    def _bucket(self, host: str) -> _HostBucket:
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = _HostBucket(self.target_rate, self.burst)
+            self.buckets[host] = bucket
+        return bucket
+
+    def rate(self, host: str) -> float:
+        return self._bucket(host).rate
+
+    # トークンを1つ取得できるまで待機
+    async def acquire(self, host: str) -> None:
+        bucket = self._bucket(host)
+        # asyncio.Lock はイベントループに紐付くため、asyncio.run の度に作り直す
+        loop = asyncio.get_running_loop()
+        if bucket.lock is None or bucket.loop is not loop:
+            bucket.lock = asyncio.Lock()
+            bucket.loop = loop
+
+        async with bucket.lock:
+            while True:
+                now = time.monotonic()
+                if bucket.blocked_until > now:
+                    await asyncio.sleep(bucket.blocked_until - now)
+                    continue
+
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * bucket.rate)
+                bucket.updated_at = now
+                if bucket.tokens >= 1.0:
+                    bucket.tokens -= 1.0
+                    return
+
+                await asyncio.sleep((1.0 - bucket.tokens) / bucket.rate)
+
+    def on_success(self, host: str) -> None:
+        bucket = self._bucket(host)
+        bucket.rate = min(self.target_rate, bucket.rate + self.rate_increase)
+
+    def on_failure(self, host: str, retry_after: float|None = None) -> None:
+        bucket = self._bucket(host)
+        bucket.rate = max(self.min_rate, bucket.rate * self.rate_decrease)
+        bucket.tokens = min(bucket.tokens, 0.0)
+        if retry_after is not None and retry_after > 0:
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + retry_after)
+
+def parse_retry_after(value: str|None) -> float|None:
+    """
+    Retry-After ヘッダ(秒数 または HTTP-date)を待機秒数に変換します。
+    """
+    if value is None or value.strip() == "":
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
@@ -7,26 +7,37 @@
 
 from argparse import Namespace
 import asyncio
+import concurrent.futures
+import datetime
+import hashlib
+from http.cookiejar import LoadError, LWPCookieJar
 from logging import Logger
 import os
 import re
+import signal
+import socket
 import time
-import zstandard as zstd
 
 import httpx
 from pyquery import PyQuery as pq
 
+from skylark.archive import SkylarkRawArchive, decompress_page
 from skylark.crud import SkylarkCrud
+from skylark.intermediate import SkylarkParsedStore
+from skylark.parser import PARSER_VERSION, parse_race_page
+from skylark.pipeline import SkylarkStageStats, report_periodically
+from skylark.ratelimit import SkylarkRateLimiter, parse_retry_after
 from skylark.util import SkylarkUtil
-
-def _write_bytes(path: str, data: bytes) -> None:
-    with open(path, "wb") as f:
-        f.write(data)
+from skylark.writer import SkylarkRaceWriter
 
 def _read_bytes(path: str) -> bytes:
     with open(path, "rb") as f:
         return f.read()
 
+# パース用ワーカープロセスではCtrl-Cを無視し、親プロセスからの終了に任せる
+def _ignore_sigint() -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
 class SkylarkScraperDb:
     def __init__(self, db_url: str, args: Namespace, logger: Logger):
         self.args = args
@@ -35,8 +46,11 @@ class SkylarkScraperDb:
         self.url_db : str = "https://db.netkeiba.com"
         self.url_login :str  = "https://account.netkeiba.com"
 
-        self.cookies = httpx.Cookies()
-        self.race_url_list = []
+        # ログインセッションのCookieはファイルに保存し、次回以降の実行でも期限内であれば再利用する
+        self.cookie_jar = LWPCookieJar(os.path.join(args.temp, "cookies.lwp"))
+        self.session_max_age: float = float(os.environ.get("NETKEIBA_SESSION_MAX_AGE", 86400))
+        # レースIDは "/race/<id>/" 文字列ではなく整数で保持
+        self.race_id_list: list[int] = []
 
         # 無視するレースID
         self.ignore_race_id: list[int] = [
@@ -47,6 +61,25 @@ class SkylarkScraperDb:
         ]
 
         self.db_crud = SkylarkCrud(db_url, logger=logger)
+        self.archive = SkylarkRawArchive(os.path.join(args.temp, "archive"), logger=logger)
+        self.writer = SkylarkRaceWriter(self.db_crud, logger=logger)
+        # パース結果のParquetへの書き出し(--write-parsed)
+        self.parsed_store = SkylarkParsedStore(os.path.join(args.temp, "parsed"), logger=logger)
+        self.write_parsed: bool = getattr(args, "write_parsed", False)
+        # 条件付きGETで再取得を確認するレース(--revalidate)
+        self.revalidate_race_ids: set[int] = set()
+        # 格納済みのページのパースに失敗したため、アーカイブを使わずに取得し直すレース
+        self.refetch_race_ids: set[int] = set()
+
+        # ホスト毎のリクエストレート制御
+        self.rate_limiter = SkylarkRateLimiter(
+            rate=float(os.environ.get("HTTP_RATE_LIMIT", 2.0)),
+            burst=float(os.environ.get("HTTP_RATE_BURST", 1.0))
+        )
+        self.http_retry: int = int(os.environ.get("HTTP_RETRY", 3))
+
+        # HTMLパースのワーカープロセス数
+        self.parse_workers: int = int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
 
     def __enter__(self):
         return self
@@ -59,88 +92,171 @@ class SkylarkScraperDb:
             self.logger.error("file not found: %s", filepath)
             return
 
+        pattern = re.compile(r"^/race/([0-9]+)/$")
         with open(filepath, "r") as file:
-            self.race_url_list = sorted([val.strip() for val in file.readlines()])
+            race_ids = set()
+            for line in file:
+                matchese: re.Match|None = pattern.match(line.strip())
+                if matchese:
+                    race_ids.add(int(matchese.group(1)))
+            self.race_id_list = sorted(race_ids)
 
     # レース結果URLリストを保存
     def export_race_url_list(self):
-        self.race_url_list = sorted(self.race_url_list)
+        self.race_id_list = sorted(set(self.race_id_list))
         filepath = os.path.join(self.args.temp, self.args.race_list_file)
 
         with open(filepath, "w") as file:
-            [file.write(path+"\n") for path in self.race_url_list]
+            [file.write(f"/race/{race_id}/\n") for race_id in self.race_id_list]
 
     def set_race_url_list(self, race_ids):
-        [self.race_url_list.append(f"/race/{race_id}/") for race_id in race_ids]
-        self.logger.debug(self.race_url_list)
+        [self.race_id_list.append(int(race_id)) for race_id in race_ids]
+        self.logger.debug(self.race_id_list)
 
     # レース結果URLを作成
-    def make_race_url_list(self, period):
-        url = self.url_db + "/?pid=race_top"
-        pattern_race = re.compile(r"^/race/[0-9]{12}/$")
-        pattern_race_list = re.compile(r"^/race/list/[0-9]{8}/$")
+    def make_race_url_list(self, period, since: datetime.date|None = None):
+        asyncio.run(self.make_race_url_list_async(period, since=since))
+
+    # DBに登録済みの最新開催日(から overlap_days 日前)以降のみを取得し、既存のリストへ追加
+    def update_race_url_list_incremental(self, period, overlap_days: int = 7) -> None:
+        watermark = self.db_crud.get_latest_race_date()
+        if watermark is None:
+            self.logger.info("no races in database, crawl %d months", period)
+            self.make_race_url_list(period)
+            return
 
-        while period > 0:
-            html: str = ""
-            try:
-                timeout = float(os.environ.get("HTTP_TIMEOUT", 5))
-                response = httpx.get(url, timeout=timeout, cookies=self.cookies)
-                html = response.text
+        since = watermark - datetime.timedelta(days=overlap_days)
+        self.logger.info("latest race date: %s, crawl since %s", watermark, since)
 
-            except Exception as ex:
-                self.logger.error(ex)
-                return
+        self.import_race_url_list()
+        known = set(self.race_id_list)
+        self.make_race_url_list(period, since=since)
 
-            if html == "":
-                self.logger.warning("html is empty")
-                continue
+        self.logger.info("new races: %d", len(set(self.race_id_list) - known))
 
-            dom = pq(html)
+    # 月別カレンダー -> 日別レース一覧 の順に、共有のHTTP/2クライアントとレート制御で並行取得
+    # since を指定した場合は、その日以降の開催日のみを対象とする
+    async def make_race_url_list_async(self, period: int, since: datetime.date|None = None):
+        pattern_race = re.compile(r"^/race/[0-9]{12}/$")
+        pattern_race_list = re.compile(r"^/race/list/([0-9]{8})/$")
+
+        # 「前月」リンクを辿らず、対象月のカレンダーURLを直接作成
+        today = datetime.date.today()
+        if since is not None:
+            period = (today.year - since.year) * 12 + today.month - since.month + 1
+        month_urls = []
+        for offset in range(period):
+            year, month = divmod(today.year * 12 + today.month - 1 - offset, 12)
+            month_urls.append(f"{self.url_db}/?pid=race_top&date={year:04d}{month + 1:02d}01")
+
+        semaphore = asyncio.Semaphore(int(os.environ.get("MAX_CONCURRENT_REQUESTS", 16)))
+        race_ids: set[int] = set()
+
+        async with self.open_client() as client:
+            async def fetch_dom(url: str):
+                response = await self.fetch(client, url, semaphore)
+                if response is None or response.text == "":
+                    self.logger.warning("html is empty: %s", url)
+                    return None
+                try:
+                    return pq(response.text)
+                except Exception as ex:
+                    self.logger.error(ex)
+                return None
 
             # 日別のrace/listを検索
-            for doc in dom("div#contents table tr td a[href ^='/race/list/']").items():
-                path = doc.attr('href')
-                if isinstance(path, str) and pattern_race_list.match(path):
-                    self.logger.info("race_list path: %s", path)
-
-                    for _ in range(1, 3):
-                        try:
-                            response = httpx.get(self.url_db + path, timeout=timeout, cookies=self.cookies)
-                            html = response.text
-
-                        except Exception as ex:
-                            self.logger.warning(ex)
-                            continue
-
-                        if html == "":
-                            self.logger.warning("html is empty")
-                            time.sleep(3) # sleep 3sec
-                            continue
-
-                        try:
-                            dom = pq(html)
-                        except Exception as ex:
-                            self.logger.error(ex)
-                        break
-
-                    # race/listから各競馬場事のrace結果URL(pathを取り出す
-                    for doc in dom("div#contents div#main div.race_list a[href ^='/race/']").items():
-                        path = doc.attr('href')
-                        if isinstance(path, str) and  pattern_race.match(path):
-                            self.race_url_list.append(path)
-                            self.logger.debug("path: %s, name: %s", path, doc.text())
-
-            # 先月分のURLを作成
-            path = dom("div#contents div.race_calendar li a").eq(1).attr("href")
-            url = f"{self.url_db}{path}"
-            period -= 1
+            race_list_paths: set[str] = set()
+            for dom in await asyncio.gather(*[fetch_dom(url) for url in month_urls]):
+                if dom is None:
+                    continue
+                for doc in dom("div#contents table tr td a[href ^='/race/list/']").items():
+                    path = doc.attr('href')
+                    if not isinstance(path, str):
+                        continue
+                    matchese: re.Match|None = pattern_race_list.match(path)
+                    if matchese is None:
+                        continue
+                    if since is not None and matchese.group(1) < since.strftime("%Y%m%d"):
+                        continue
+                    race_list_paths.add(path)
+
+            self.logger.info("race_list paths: %d", len(race_list_paths))
+
+            # race/listから各競馬場事のrace結果URL(pathを取り出す
+            for dom in await asyncio.gather(*[fetch_dom(self.url_db + path) for path in sorted(race_list_paths)]):
+                if dom is None:
+                    continue
+                for doc in dom("div#contents div#main div.race_list a[href ^='/race/']").items():
+                    path = doc.attr('href')
+                    if isinstance(path, str) and pattern_race.match(path):
+                        race_ids.add(int(path.rsplit("/", 2)[1]))
+                        self.logger.debug("path: %s, name: %s", path, doc.text())
+
+        self.race_id_list = sorted(race_ids.union(self.race_id_list))
+
+    # 保存済みのCookieファイル(cookie_jar)を共有する、クロール全体で使い回すHTTP/2クライアント
+    # コネクションプールの上限は並行数に合わせ、キープアライブで接続を再利用する
+    def open_client(self, max_connections: int|None = None) -> httpx.AsyncClient:
+        if max_connections is None:
+            max_connections = int(os.environ.get("MAX_CONCURRENT_REQUESTS", 16))
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60)))
+        return httpx.AsyncClient(http2=True, cookies=self.cookie_jar, limits=limits)
+
+    # 保存済みのログインセッションを読み込み、再利用できれば True を返す
+    # 有効期限切れのCookieは読み込まず、期限のないCookieもファイルが session_max_age 秒より古ければ破棄する
+    def load_session(self) -> bool:
+        path = self.cookie_jar.filename
+        if path is None or os.path.isfile(path) == False:
+            return False
+        if time.time() - os.path.getmtime(path) > self.session_max_age:
+            return False
+        try:
+            self.cookie_jar.load(ignore_discard=True)
+        except (LoadError, OSError) as ex:
+            self.logger.warning("failed to load session: %s", ex)
+            return False
+        return len(self.cookie_jar) > 0
+
+    # Cookieファイルはログイン中のセッションを含むため、所有者のみ読み書きできるようにする
+    def save_session(self) -> None:
+        path = self.cookie_jar.filename
+        try:
+            if path is not None:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+                os.chmod(path, 0o600)
+            self.cookie_jar.save(ignore_discard=True)
+        except OSError as ex:
+            self.logger.warning("failed to save session: %s", ex)
+
+    # 読み込んだセッションがサーバー側でまだ有効か確認(ログイン済みであればログインフォームが表示されない)
+    async def check_session(self, client: httpx.AsyncClient) -> bool:
+        timeout = float(os.environ.get("HTTP_TIMEOUT", 5))
+        try:
+            response = await client.get(self.url_login, timeout=timeout)
+        except httpx.HTTPError as ex:
+            self.logger.warning("failed to check login session: %s", ex)
+            return False
+        if response.status_code != 200:
+            return False
+        return len(pq(response.text)('input[name="login_id"]')) == 0
 
     # netkeibaにログイン
-    def login(self, client: httpx.Client) -> bool|None:
+    async def login(self, client: httpx.AsyncClient) -> bool|None:
         login_id = os.getenv("NETKEIABA_LOGINID","")
         password = os.getenv("NETKEIABA_PASSWORD","")
 
         if login_id != "" and password != "":
+            if self.load_session() == True:
+                if await self.check_session(client) == True:
+                    self.logger.info("reuse login session: %s", self.cookie_jar.filename)
+                    return True
+                # サーバー側でセッションが切れている場合は、ログインし直す
+                self.logger.info("login session expired: %s", self.cookie_jar.filename)
+                self.cookie_jar.clear()
+
             post = {
                 'pid'        : "login",
                 'action'     : "auth",
@@ -148,9 +264,8 @@ class SkylarkScraperDb:
                 'pswd'       : password
             }
 
-            print(login_id, password)
             timeout = float(os.environ.get("HTTP_TIMEOUT", 5))
-            response = client.post(self.url_login, data=post, timeout=timeout, cookies=self.cookies)
+            response = await client.post(self.url_login, data=post, timeout=timeout)
             html = response.text
             dom = pq(html)
 
@@ -160,412 +275,1004 @@ class SkylarkScraperDb:
                 return False
 
             # ログイン成功
+            self.save_session()
             return True
 
         return None
 
+    # レースリストをジョブキュー(crawl_job_tbl)へ登録し、登録したレースIDを返す
+    def seed_crawl_queue(self) -> set[int]:
+        race_ids = set(self.race_id_list) - set(self.ignore_race_id)
+
+        # --force 指定時も、再確認するレースはアーカイブ済みページで条件付きGETを行う
+        revalidate_race_ids = self.load_revalidate_race_ids()
+
+        # 取り込み済みのレースは、--force 指定時以外はスケジュールしない
+        if self.args.force == False and len(race_ids) > 0:
+            stored = self.db_crud.get_stored_race_ids(min(race_ids), max(race_ids))
+            stored &= race_ids
+
+            # 再確認するレースは取り込み済みでもスケジュールする
+            stored -= revalidate_race_ids
+
+            if len(stored) > 0:
+                self.logger.info("skip %d races already stored", len(stored))
+                race_ids -= stored
+
+        if len(race_ids) == 0:
+            return race_ids
+
+        self.db_crud.seed_crawl_jobs(sorted(race_ids))
+        if self.args.force == True:
+            # 前回 stored・rejected となったジョブも再度処理対象とし、再パースした結果で既存の行を更新する
+            self.db_crud.update_crawl_jobs_status(sorted(race_ids), "pending")
+            self.writer.update = True
+        elif len(self.revalidate_race_ids & race_ids) > 0:
+            self.db_crud.update_crawl_jobs_status(sorted(self.revalidate_race_ids & race_ids), "pending")
+        return race_ids
+
+    # 開催日から --revalidate 日以内のレースは、払戻や失格などの訂正を取り込むため条件付きGETで再確認する
+    def load_revalidate_race_ids(self) -> set[int]:
+        revalidate_days = getattr(self.args, "revalidate", None)
+        if revalidate_days is None:
+            return self.revalidate_race_ids
+
+        date_from = datetime.date.today() - datetime.timedelta(days=revalidate_days)
+        self.revalidate_race_ids = set(self.db_crud.get_race_ids_since(date_from))
+        self.logger.info("revalidate %d races since %s", len(self.revalidate_race_ids), date_from)
+        if len(self.revalidate_race_ids) > 0:
+            # 変更のあったレースは再パースし、既存の行を更新する
+            self.writer.update = True
+        return self.revalidate_race_ids
+
     # ダウンロード実行
     def download(self):
-        if len(self.race_url_list) == 0:
+        if len(self.race_id_list) == 0:
+            return
+
+        # ジョブ状態を登録し、未完了のレースのみ処理する(中断した実行の再開、失敗したレースの再試行)
+        race_ids = self.seed_crawl_queue()
+        if len(race_ids) == 0:
             return
 
-        with httpx.Client(http2=True) as client:
-            result = self.login(client)
+        try:
+            asyncio.run(self.download_async(race_ids))
+        finally:
+            self.writer.flush()
+            self.parsed_store.flush()
+            self.writer.log_insert_counts()
+
+    # ログインから再試行までを1つのクライアントで行い、接続とセッションをクロール全体で使い回す
+    async def download_async(self, race_ids: set[int]):
+        max_concurrent_requests = int(os.environ.get("MAX_CONCURRENT_REQUESTS", 16))
+        max_attempts = int(os.environ.get("CRAWL_MAX_ATTEMPTS", 5))
+        # 次回の再試行までの待ち時間がこれより長い場合は、次回の実行に任せる
+        retry_wait_max = float(os.environ.get("CRAWL_RETRY_WAIT_MAX", 300))
+
+        async with self.open_client(max_concurrent_requests) as client:
+            result = await self.login(client)
             self.logger.info("login: %s", result)
 
-        asyncio.run(
-            self.download_concurrently(
-                max_concurrent_requests=int(os.environ.get("MAX_CONCURRENT_REQUESTS", 16))
-            )
-        )
+            while True:
+                jobs = await asyncio.to_thread(self.db_crud.get_retryable_crawl_jobs, max_attempts)
+                now = datetime.datetime.now()
+                due = sorted(race_id for race_id, next_attempt_at in jobs.items()
+                    if race_id in race_ids and (next_attempt_at is None or next_attempt_at <= now))
 
-    async def download_concurrently(self, max_concurrent_requests: int=16):
-        pattern = re.compile(r"^/race/([0-9]+)/$")
+                if len(due) == 0:
+                    waiting = [next_attempt_at for race_id, next_attempt_at in jobs.items()
+                        if race_id in race_ids and next_attempt_at is not None]
+                    if await self._wait_for_retry(waiting, retry_wait_max) == False:
+                        break
+                    continue
 
-        async with httpx.AsyncClient(http2=True) as client:
-            semaphore = asyncio.Semaphore(max_concurrent_requests)  # 並行数を制御
-            tasks = []
+                self.logger.info("crawl jobs: %d due, %d total", len(due), len(race_ids))
+                await self.download_concurrently(max_concurrent_requests, race_ids=due, client=client)
+                await asyncio.to_thread(self.writer.flush)
 
-            async def limited_download(idx: int, url: str, filepath: str):
-                async with semaphore:
-                    race_id = int(url.rsplit("/", 2)[1])
+            if result == True:
+                self.save_session()
 
-                    try:
-                        self.ignore_race_id.index(race_id)
-                        self.logger.warning("[%5d] race_id: %d, url: %s, reject[ignore_race_id]", idx, race_id, url)
-                        return
-                    except ValueError as ex:
-                        self.logger.debug("[%5d] race_id: %d, url: %s, start", idx, race_id, url)
+    # ジョブ状態の更新に失敗してもパイプラインは止めない(未完了のジョブは次回再開される)
+    def set_job_status(self, race_id: int, status: str) -> None:
+        try:
+            self.db_crud.update_crawl_jobs_status([race_id], status)
+        except Exception as ex:
+            self.logger.warning("race_id: %d, failed to update job status[%s]: %s", race_id, status, ex)
 
-                    html = None
+    # DBのジョブキュー(crawl_job_tbl)からジョブを取得しながら処理
+    # 複数のプロセス・ノードから同じDBに対して同時に実行できる
+    def work_queue(self):
+        self.load_revalidate_race_ids()
+        # -U --force で登録し直したレースを処理する場合は、既存の行を更新する
+        if self.args.force == True:
+            self.writer.update = True
 
-                    if os.path.isfile(filepath) == False:
-                        try:
-                            response = await client.get(
-                                url,
-                                timeout=float(os.environ.get("HTTP_TIMEOUT", 5))
-                            )
-                            response.raise_for_status()
+        try:
+            asyncio.run(self.work_queue_async())
+        finally:
+            self.writer.flush()
+            self.parsed_store.flush()
+            self.writer.log_insert_counts()
+
+    async def work_queue_async(self):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"[:64]
+        max_concurrent_requests = int(os.environ.get("MAX_CONCURRENT_REQUESTS", 16))
+        claim_batch = int(os.environ.get("CRAWL_CLAIM_BATCH", 100))
+        lease_seconds = float(os.environ.get("CRAWL_LEASE_SECONDS", 600))
+        max_attempts = int(os.environ.get("CRAWL_MAX_ATTEMPTS", 5))
+        retry_wait_max = float(os.environ.get("CRAWL_RETRY_WAIT_MAX", 300))
+
+        async with self.open_client(max_concurrent_requests) as client:
+            result = await self.login(client)
+            self.logger.info("login: %s", result)
 
-                            try:
-                                # EUC-JPエンコーディングでデコードし、UTF-8に変換
-                                html = response.content.decode("euc-jp", errors="replace")
-                            except UnicodeDecodeError:
-                                # 既にUTF-8または他のエンコーディングの場合
-                                html = response.text
+            while True:
+                race_ids = await asyncio.to_thread(
+                    self.db_crud.claim_crawl_jobs, worker_id, claim_batch, lease_seconds, max_attempts)
+                if len(race_ids) == 0:
+                    now = datetime.datetime.now()
+                    jobs = await asyncio.to_thread(self.db_crud.get_retryable_crawl_jobs, max_attempts)
+                    waiting = [next_attempt_at for next_attempt_at in jobs.values()
+                        if next_attempt_at is not None and next_attempt_at > now]
+                    if await self._wait_for_retry(waiting, retry_wait_max) == False:
+                        break
+                    continue
 
-                        except Exception as ex:
-                            self.logger.warning(ex, exc_info=True)
-                            await asyncio.sleep(1) # sleep 1sec
-                            return
+                self.logger.info("worker: %s, claimed %d jobs (%d - %d)", worker_id, len(race_ids), race_ids[0], race_ids[-1])
+                await self.download_concurrently(max_concurrent_requests, race_ids=race_ids, client=client)
+                await asyncio.to_thread(self.writer.flush)
+
+            if result == True:
+                self.save_session()
+
+    # 再試行待ちのジョブがあれば次回試行日時まで待機
+    # 待ち時間が retry_wait_max 秒より長い場合は待たずに False を返し、次回の実行に任せる
+    async def _wait_for_retry(self, waiting: list[datetime.datetime], retry_wait_max: float) -> bool:
+        if len(waiting) == 0:
+            return False
+
+        wait = (min(waiting) - datetime.datetime.now()).total_seconds()
+        if wait > retry_wait_max:
+            self.logger.info("%d races are waiting for retry, next retry in %.0fs", len(waiting), wait)
+            return False
+
+        self.logger.info("%d races are waiting for retry, sleep %.0fs", len(waiting), wait)
+        await asyncio.sleep(max(0.0, wait))
+        return True
+
+    # レート制御・リトライ付きのGET
+    # レート制御による待機は並行数の枠(semaphore)の外で行い、枠はリクエスト中のみ保持する
+    # stream=True の場合はボディを読み込まずに返すため、呼び出し側で読み込み後に aclose すること
+    # raise_for_status=True の場合、再試行しないエラー(429以外の4xx)は httpx.HTTPStatusError を送出する
+    async def fetch(self, client: httpx.AsyncClient, url: str, semaphore: asyncio.Semaphore|None = None,
+                    stream: bool = False, headers: dict|None = None,
+                    raise_for_status: bool = False) -> httpx.Response|None:
+        host = httpx.URL(url).host
+        timeout = float(os.environ.get("HTTP_TIMEOUT", 5))
+
+        for attempt in range(1, self.http_retry + 1):
+            await self.rate_limiter.acquire(host)
 
-                        self.logger.info("[%5d] race_id: %d, url: %s, download finish", idx, race_id, url)
+            try:
+                request = client.build_request("GET", url, headers=headers, timeout=timeout)
+                if semaphore is None:
+                    response = await client.send(request, stream=stream)
+                else:
+                    async with semaphore:
+                        response = await client.send(request, stream=stream)
+            except httpx.TimeoutException as ex:
+                self.rate_limiter.on_failure(host)
+                self.logger.warning("url: %s, timeout (%d/%d), rate: %.2f/s",
+                    url, attempt, self.http_retry, self.rate_limiter.rate(host))
+                continue
+            except httpx.HTTPError as ex:
+                self.rate_limiter.on_failure(host)
+                self.logger.warning("url: %s, %s (%d/%d)", url, ex, attempt, self.http_retry)
+                continue
 
-                        compressed = await asyncio.to_thread(zstd.compress, html.encode("utf-8"))
-                        await asyncio.to_thread(_write_bytes, filepath, compressed)
+            if response.status_code == 429 or response.status_code >= 500:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                self.rate_limiter.on_failure(host, retry_after)
+                self.logger.warning("url: %s, status: %d (%d/%d), rate: %.2f/s, retry-after: %s",
+                    url, response.status_code, attempt, self.http_retry, self.rate_limiter.rate(host), retry_after)
+                await response.aclose()
+                continue
 
-                        await asyncio.sleep(1) # sleep 1sec
+            if response.is_error:
+                self.logger.warning("url: %s, status: %d", url, response.status_code)
+                await response.aclose()
+                if raise_for_status == True:
+                    response.raise_for_status()
+                return None
 
-                    else:
-                        self.logger.info("[%5d] race_id: %d, url: %s, downloaded", idx, race_id, url)
+            self.rate_limiter.on_success(host)
+            return response
 
-                        data = await asyncio.to_thread(_read_bytes, filepath)
-                        html_bytes = await asyncio.to_thread(zstd.decompress, data)
-                        html = html_bytes.decode("utf-8", errors="replace")
+        return None
 
-                    if html == None:
-                        self.logger.warning("[%5d] race_id: %d, url: %s, no data", idx, race_id, url)
-                    else:
-                        await asyncio.to_thread(self.scraping_html, race_id, html)
+    # ページを取得し、受信したバイト列をデコードせずにそのままzstdで逐次圧縮する
+    # 文字コード・ETag・Last-Modified・内容のハッシュはメタデータとして返す
+    # cached(アーカイブ済みページのメタデータ)を渡した場合、変更がなければ (None, cached) を返す
+    # 再試行しないエラー(429以外の4xx)は httpx.HTTPStatusError を送出する
+    async def fetch_page(self, client: httpx.AsyncClient, url: str,
+                         cached: dict|None = None) -> tuple[bytes|None, dict]|None:
+        headers = {}
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        response = await self.fetch(client, url, stream=True, headers=headers, raise_for_status=True)
+        if response is None:
+            return None
 
-                    self.logger.debug("[%5d] url: %s, done", idx, url)
+        try:
+            if response.status_code == 304 and cached is not None:
+                return None, cached
+
+            compressor = self.archive.compressor().compressobj()
+            digest = hashlib.sha256()
+            chunks: list[bytes] = []
+            async for chunk in response.aiter_bytes():
+                digest.update(chunk)
+                chunks.append(compressor.compress(chunk))
+            chunks.append(compressor.flush())
+        except httpx.HTTPError as ex:
+            self.logger.warning("url: %s, %s", url, ex)
+            return None
+        finally:
+            await response.aclose()
+
+        meta = {
+            "charset": response.charset_encoding or "euc-jp",
+            "sha256": digest.hexdigest(),
+        }
+        if response.headers.get("ETag"):
+            meta["etag"] = response.headers["ETag"]
+        if response.headers.get("Last-Modified"):
+            meta["last_modified"] = response.headers["Last-Modified"]
+
+        # 検証用ヘッダを返さないサーバーでも、内容が同じであれば変更なしとする
+        if cached is not None and cached.get("sha256") == meta["sha256"]:
+            return None, cached
+        return b"".join(chunks), meta
+
+    async def download_concurrently(self, max_concurrent_requests: int=16, race_ids: list[int]|None = None,
+                                    client: httpx.AsyncClient|None = None):
+        if race_ids is None:
+            race_ids = self.race_id_list
+        if client is None:
+            async with self.open_client(max_concurrent_requests) as client:
+                await self.download_concurrently(max_concurrent_requests, race_ids, client)
+            return
 
-            for idx, url_path in enumerate(self.race_url_list):
-                matchese: re.Match|None = pattern.match(url_path)
-                if not matchese:
-                    continue
+        # ステージ毎の並行数とキューの上限
+        parse_workers = self.parse_workers
+        fetch_queue: asyncio.Queue = asyncio.Queue(maxsize=max_concurrent_requests * 2)
+        cache_workers = int(os.environ.get("CACHE_WORKERS", 4))
+        cache_queue: asyncio.Queue = asyncio.Queue(maxsize=cache_workers * 2)
+        parse_queue: asyncio.Queue = asyncio.Queue(maxsize=int(os.environ.get("PARSE_QUEUE_SIZE", parse_workers * 2)))
+        write_queue: asyncio.Queue = asyncio.Queue(maxsize=int(os.environ.get("WRITE_QUEUE_SIZE", self.writer.batch_size * 2)))
 
-                url = self.url_db + url_path
-                filepath = os.path.join(self.args.temp, "race." + matchese.group(1) + ".html.zst")
+        fetch_stats = SkylarkStageStats("fetch", fetch_queue)
+        parse_stats = SkylarkStageStats("parse", parse_queue)
+        write_stats = SkylarkStageStats("write", write_queue)
 
-                tasks.append(limited_download(idx, url, filepath))
+        loop = asyncio.get_running_loop()
 
-            results = await asyncio.gather(*tasks)
-            return results
+        # 取得済みのページ(アーカイブ・race.<id>.html.zst)を読み込むレースか
+        def is_cached(race_id: int) -> bool:
+            if race_id in self.refetch_race_ids:
+                return False
+            # 再確認するレースは、アーカイブにない(ETag/Last-Modifiedのない)ページも取得し直す
+            if race_id in self.revalidate_race_ids:
+                return False
+            if race_id in self.archive:
+                return True
+            return os.path.isfile(os.path.join(self.args.temp, f"race.{race_id}.html.zst"))
+
+        # レースIDを少しずつ投入し、リストの長さによらずメモリ使用量を一定に保つ
+        # 取得済みのページは cache_queue へ分け、レート制御の待機中の取得ワーカーの後ろに並ばせない
+        async def produce(fetch_workers: int, cache_workers: int):
+            for idx, race_id in enumerate(race_ids):
+                if race_id in self.ignore_race_id:
+                    self.logger.warning("[%5d] race_id: %d, reject[ignore_race_id]", idx, race_id)
+                    continue
+                if is_cached(race_id):
+                    await cache_queue.put((idx, race_id))
+                else:
+                    await fetch_queue.put((idx, race_id))
+            for _ in range(fetch_workers):
+                await fetch_queue.put(None)
+            for _ in range(cache_workers):
+                await cache_queue.put(None)
+
+        # cache: アーカイブ・キャッシュの読み込み -> parse_queue (並行数の枠・レート制御を使わない)
+        async def cache_worker():
+            while True:
+                item = await cache_queue.get()
+                if item is None:
+                    return
+
+                idx, race_id = item
+                url = f"{self.url_db}/race/{race_id}/"
+                if race_id in self.archive:
+                    self.logger.info("[%5d] race_id: %d, url: %s, archived", idx, race_id, url)
+
+                    # 展開・デコードはパース側のプロセスで行う
+                    meta, compressed = await asyncio.to_thread(self.archive.get, race_id)  # type: ignore
+                    fetch_stats.done()
+                    await asyncio.to_thread(self.set_job_status, race_id, "fetched")
+                    await parse_queue.put((idx, race_id, None, compressed, meta.get("charset", "utf-8"), False))
+                    continue
 
-    def scraping_html(self, race_id: int, html: str) -> None:
-        db_crud: SkylarkCrud = self.db_crud
-        try:
-            dataset_horse :list   = []
-            dataset_jockey :list  = []
-            dataset_trainer :list = []
-            dataset_owner :list   = []
-            dataset_result :list  = []
-            dataset_payoff :list  = []
+                self.logger.info("[%5d] race_id: %d, url: %s, downloaded", idx, race_id, url)
 
-            dom = pq(html)
-            race_head = dom("html body div#page div#main div.race_head")
+                # キャッシュ済みの場合は読み込み・展開もパース側のプロセスで行う
+                filepath = os.path.join(self.args.temp, f"race.{race_id}.html.zst")
+                fetch_stats.done()
+                await asyncio.to_thread(self.set_job_status, race_id, "fetched")
+                await parse_queue.put((idx, race_id, filepath, None, "utf-8", False))
 
-            # init
-            data_race_name = None
-            data_distance = None
-            data_weather = None
-            data_post_time = None
-            data_race_number = None
-            data_track_surface = None
-            data_track_condition = None
-            data_track_condition_org = None
-            data_track_condition_score = None
-            data_run_direction = None
-            data_track_surface_org = None
-            data_place_detail = None
-            data_race_class = None
-            data_date = None
-
-            data_race_number_text = str(race_head("dl.racedata dt").text())
-            if data_race_number_text:
-                data_race_number = int(data_race_number_text.split(" ", 1)[0])
-            else:
-                data_race_number = None
-
-            data_race_name = race_head("dl.racedata dd h1").text()
-
-            # track_surface, distance, weather, track_condition, post_time
-            race_info_text = str(race_head("dl.racedata dd p span").text())
-            matchese: re.Match | None = re.match(
-                r'^([^\d ]+).*?(\d{4})m\s*/\s*天候 : (\w+)\s*/\s*(.+)\s+/\s+発走 : (\d{1,2}:\d{1,2})',
-                race_info_text,
-                re.U
-            )
-            if matchese:
-                data_track_surface_org = matchese.group(1)
-                if re.search(r'^芝', data_track_surface_org):
-                    data_track_surface = "芝"
-                elif re.search(r'^ダ', data_track_surface_org):
-                    data_track_surface = "ダート"
-                elif re.search(r'^障', data_track_surface_org):
-                    data_track_surface = "障害"
-
-                if re.search(r'^.*左', data_track_surface_org):
-                    data_run_direction = "左"
-                elif re.search(r'^.*右', data_track_surface_org):
-                    data_run_direction = "右"
-                elif re.search(r'^.*直線', data_track_surface_org):
-                    data_run_direction = "直線"
-
-                if data_run_direction is not None and re.search(r'^.*外$', data_track_surface_org):
-                    data_run_direction = data_run_direction + " 外"
-
-                data_distance = int(matchese.group(2))
-
-                data_weather = matchese.group(3)
-
-                data_track_condition_org = matchese.group(4)
-                matchese_condition = re.match(r'^.*?\s*:\s*(\w+)\s*', data_track_condition_org, re.U)
-                if matchese_condition:
-                    data_track_condition = matchese_condition.group(1)
-
-                data_post_time = matchese.group(5)
-
-            # date, place_detail, class
-            text_value = str(race_head("div.mainrace_data p").eq(1).text()).replace('\u00A0', ' ').strip()
-            matchese = re.match(r'^(\d{4})年\s*(\d{1,2})月\s*(\d{1,2})日\s*(\S+?)(?:\s+(.+))?$', text_value)
-            if matchese:
-                data_date = matchese.group(1) + "-" + matchese.group(2) + "-" + matchese.group(3)
-                data_place_detail = matchese.group(4)
-                data_race_class = matchese.group(5)
-
-            race_head = None
-
-            dataset_info: dict = {
-                "id":race_id,
-                "race_name":data_race_name,
-                "distance":data_distance,
-                "weather":data_weather,
-                "post_time":data_post_time,
-                "race_number":data_race_number,
-                "run_direction":data_run_direction,
-                "track_surface":data_track_surface,
-                "track_condition":data_track_condition,
-                "track_condition_score":data_track_condition_score,
-                "date":data_date,
-                "place_detail":data_place_detail,
-                "race_grade":SkylarkUtil.convertToClass2Int(data_race_class),
-                "race_class":data_race_class
-            }
+        # fetch: ダウンロード -> parse_queue
+        async def fetch_worker():
+            while True:
+                item = await fetch_queue.get()
+                if item is None:
+                    return
 
-            db_crud.insert_race_info(dataset_info)
+                idx, race_id = item
+                url = f"{self.url_db}/race/{race_id}/"
+                self.logger.debug("[%5d] race_id: %d, url: %s, start", idx, race_id, url)
 
-            race_result = dom("html body div#page div#contents_liquid table tr")
-            for result_row in race_result[1:]:
-                columns = pq(result_row).find("td")
+                refetch = race_id in self.refetch_race_ids
+                # 再確認するレースは、アーカイブ済みページのETag/Last-Modifiedで条件付きGETを行う
+                cached = None
+                if race_id in self.revalidate_race_ids and race_id in self.archive and refetch == False:
+                    cached, _ = await asyncio.to_thread(self.archive.get, race_id)  # type: ignore
 
-                #着順
-                order_of_finish = str(columns.eq(0).text())
                 try:
-                    order_of_finish = int(order_of_finish)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    order_of_finish = None
+                    result = await self.fetch_page(client, url, cached)
+                except httpx.HTTPStatusError as ex:
+                    # 存在しないレースなどは再試行しても変わらないため、バックオフせずに終える
+                    self.logger.warning("[%5d] race_id: %d, url: %s, status: %d, rejected",
+                        idx, race_id, url, ex.response.status_code)
+                    fetch_stats.done(failed=True)
+                    await asyncio.to_thread(self.db_crud.reject_crawl_job, race_id,
+                        f"fetch failed: {url}, status: {ex.response.status_code}")
+                    continue
+                if result is None:
+                    self.logger.warning("[%5d] race_id: %d, url: %s, no data", idx, race_id, url)
+                    fetch_stats.done(failed=True)
+                    await asyncio.to_thread(self.db_crud.fail_crawl_job, race_id, "fetch failed: " + url)
+                    continue
 
-                #枠番
-                bracket_number = str(columns.eq(1).text())
-                try:
-                    bracket_number = int(bracket_number)
-                except ValueError as ex:
-                    self.logger.warning(ex)
+                compressed, meta = result
+                if compressed is None:
+                    # 変更がなければ再パースしない
+                    self.logger.info("[%5d] race_id: %d, url: %s, not modified", idx, race_id, url)
+                    fetch_stats.done()
+                    await asyncio.to_thread(self.set_job_status, race_id, "stored")
+                    continue
+
+                self.logger.info("[%5d] race_id: %d, url: %s, download finish", idx, race_id, url)
 
-                #馬番
-                horse_number = str(columns.eq(2).text())
+                await asyncio.to_thread(self.archive.put, race_id, compressed, meta)
+                charset = meta["charset"]
+
+                fetch_stats.done()
+                await asyncio.to_thread(self.set_job_status, race_id, "fetched")
+                # parse_queue が一杯の間は待ち、後段の詰まりをダウンロードへ伝える
+                await parse_queue.put((idx, race_id, None, compressed, charset, True))
+
+        # parse: parse_queue -> write_queue
+        async def parse_worker(executor: concurrent.futures.Executor):
+            while True:
+                item = await parse_queue.get()
+                if item is None:
+                    return
+
+                idx, race_id, filepath, compressed, charset, downloaded = item
                 try:
-                    horse_number = int(horse_number)
-                except ValueError as ex:
-                    self.logger.warning(ex)
+                    record = await loop.run_in_executor(executor, parse_race, race_id, None, filepath, self.logger,
+                        compressed, self.archive.dict_dir, charset)
+                except Exception as ex:
+                    self.logger.error("[%5d] race_id: %d, parse failed: %s", idx, race_id, ex)
+                    record = None
+                parse_stats.done(failed=record is None)
+                if record is None:
+                    if downloaded == False:
+                        # 格納済みのページ(エラーページ・ログイン前のページなど)は何度パースしても同じため、
+                        # 待たずに再試行し、その際はネットワークから取得し直す
+                        self.refetch_race_ids.add(race_id)
+                        await asyncio.to_thread(self.db_crud.fail_crawl_job, race_id, "parse failed: archived page", False)
+                    else:
+                        # 取得したばかりのページでも失敗する場合は、再試行しない
+                        await asyncio.to_thread(self.db_crud.reject_crawl_job, race_id, "parse failed")
+                    continue
+
+                await asyncio.to_thread(self.set_job_status, race_id, "parsed")
+                if self.write_parsed == True:
+                    await asyncio.to_thread(self.parsed_store.add, record)
+                await write_queue.put(record)
+                self.logger.debug("[%5d] race_id: %d, parsed", idx, race_id)
 
-                #馬ID
-                horse_id = str(columns.eq(3).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+        # write: write_queue -> DB (グループコミット)
+        async def write_worker():
+            while True:
                 try:
-                    horse_id = int(horse_id)
-                except ValueError as ex:
-                    self.logger.warning(ex)
-
-                #馬名
-                horse_name = str(columns.eq(3).find("a").eq(0).text())
-
-                #性別、年齢
-                sex = None
-                age = 0
-                matchese = None
-                matchese = re.match(r'^(.)(\d+)$', str(columns.eq(4).text()))
-                if matchese:
-                    sex = matchese.group(1)
-                    age = int(matchese.group(2))
+                    # 書き込み待ちのレースがあれば、待ち時間の上限までに次が届かなければ書き込む
+                    record = await asyncio.wait_for(write_queue.get(), timeout=self.writer.seconds_until_due())
+                except asyncio.TimeoutError:
+                    await asyncio.to_thread(self.writer.flush_if_due)
+                    continue
 
-                #斤量
-                basis_weight = float(str(columns.eq(5).text()))
+                if record is None:
+                    await asyncio.to_thread(self.writer.flush)
+                    return
+
+                await asyncio.to_thread(self.writer.add, record)
+                write_stats.done()
+
+        stats_list = [fetch_stats, parse_stats, write_stats]
+        reporter = asyncio.create_task(
+            report_periodically(stats_list, self.logger, float(os.environ.get("PIPELINE_STATS_INTERVAL", 30))))
+
+        # pyqueryでのパースはGILに律速されるため、プロセスプールで並列化
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers, initializer=_ignore_sigint)
+        fetchers = [asyncio.create_task(fetch_worker()) for _ in range(max_concurrent_requests)]
+        fetchers += [asyncio.create_task(cache_worker()) for _ in range(cache_workers)]
+        producer = asyncio.create_task(produce(max_concurrent_requests, cache_workers))
+        parsers = [asyncio.create_task(parse_worker(executor)) for _ in range(parse_workers)]
+        writer = asyncio.create_task(write_worker())
+        tasks = [producer, *fetchers, *parsers, writer, reporter]
+        try:
+            await asyncio.gather(producer, *fetchers)
+
+            # 前段から順に終了を伝える
+            for _ in parsers:
+                await parse_queue.put(None)
+            await asyncio.gather(*parsers)
+            await write_queue.put(None)
+            await writer
+        finally:
+            # Ctrl-C(キャンセル)や例外の場合も全ワーカーを止める
+            # 書き込み待ちのレースは download() で flush し、未処理分はジョブ状態から再開する
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        for stats in stats_list:
+            stats.report(self.logger)
+
+    # アーカイブ・キャッシュ済みの race.<id>.html.zst からネットワークを使わずに再取り込み
+    def reingest(self, race_id_from: int|None = None, race_id_to: int|None = None,
+                 date_from: datetime.date|None = None, date_to: datetime.date|None = None,
+                 race_ids: set[int]|None = None) -> None:
+        pattern = re.compile(r"^race\.([0-9]{12})\.html\.zst$")
+
+        def in_range(race_id: int) -> bool:
+            if race_id in self.ignore_race_id:
+                return False
+            if race_ids is not None and race_id not in race_ids:
+                return False
+            if race_id_from is not None and race_id < race_id_from:
+                return False
+            if race_id_to is not None and race_id > race_id_to:
+                return False
+            # レースIDの先頭4桁は開催年のため、日付指定の範囲外の年はパース前に除外
+            year = race_id // 100000000
+            if date_from is not None and year < date_from.year:
+                return False
+            if date_to is not None and year > date_to.year:
+                return False
+            return True
 
-                #騎手
-                jockey_id = str(columns.eq(6).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
-                jockey_name = columns.eq(6).find("a").eq(0).text()
+        archived_ids = [race_id for race_id in self.archive.race_ids() if in_range(race_id)]
 
-                #タイム
-                finishing_time = None
-                matchese = re.match(r'^(\d+:\d+\.\d+)$', str(columns.eq(7).text()))
-                if matchese:
-                    finishing_time = '00:'+matchese.group(1)
+        # アーカイブへ未移行のファイル
+        race_files: list[tuple[int, str]] = []
+        with os.scandir(self.args.temp) as entries:
+            for entry in entries:
+                matchese = pattern.match(entry.name)
+                if not matchese:
+                    continue
 
-                #着差
-                margin = str(columns.eq(8).text())
+                race_id = int(matchese.group(1))
+                if in_range(race_id) and race_id not in self.archive.index:
+                    race_files.append((race_id, entry.path))
+        race_files.sort()
+
+        self.logger.info("reingest: %d archived, %d files", len(archived_ids), len(race_files))
+
+        def sources():
+            for race_id, meta, compressed in self.archive.scan(archived_ids):
+                yield race_id, None, compressed, meta.get("charset", "utf-8")
+            for race_id, filepath in race_files:
+                yield race_id, filepath, None, "utf-8"
+
+        parsed = 0
+        skipped = 0
+        failed = 0
+        started_at = time.monotonic()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.parse_workers, initializer=_ignore_sigint) as executor:
+            futures: set[concurrent.futures.Future] = set()
+            pages = sources()
+
+            while True:
+                # 投入するジョブ数を抑え、メモリ使用量を一定に保つ
+                for race_id, filepath, compressed, charset in pages:
+                    futures.add(executor.submit(parse_race, race_id, None, filepath, self.logger,
+                        compressed, self.archive.dict_dir, charset))
+                    if len(futures) >= self.parse_workers * 4:
+                        break
 
-                #タイム指数(有料)
-                try:
-                    speed_figure = int(str(columns.eq(9).text()))
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    speed_figure =  None
+                if len(futures) == 0:
+                    break
 
-                #通過
-                passing_rank = str(columns.eq(10).text())
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        record = future.result()
+                    except Exception as ex:
+                        self.logger.error(ex)
+                        record = None
+
+                    if record is None:
+                        failed += 1
+                        continue
+
+                    race_date = SkylarkUtil.convertToDate(record["race_info"]["date"])
+                    if (date_from is not None and (race_date is None or race_date < date_from)) or \
+                       (date_to is not None and (race_date is None or race_date > date_to)):
+                        skipped += 1
+                        continue
+
+                    if self.write_parsed == True:
+                        self.parsed_store.add(record)
+                    self.writer.add(record)
+                    parsed += 1
+
+                self.writer.flush_if_due()
+
+        self.writer.flush()
+        self.parsed_store.flush()
+        elapsed = time.monotonic() - started_at
+        self.logger.info("reingest: parsed %d, skipped %d, failed %d in %.1fs (%.2f races/s)",
+            parsed, skipped, failed, elapsed, parsed / elapsed if elapsed > 0 else 0.0)
+        self.writer.log_insert_counts()
+
+    # HTMLをパースせず、Parquetに書き出したパース結果からDBへ書き込み
+    def load_parsed(self, date_from: datetime.date|None = None, date_to: datetime.date|None = None) -> None:
+        started_at = time.monotonic()
+        loaded = 0
+        for record in self.parsed_store.iter_records(
+                year_from=date_from.year if date_from is not None else None,
+                year_to=date_to.year if date_to is not None else None):
+            race_date = record["race_info"]["date"]
+            if (date_from is not None and race_date < date_from) or (date_to is not None and race_date > date_to):
+                continue
+            self.writer.add(record)
+            loaded += 1
+        self.writer.flush()
+
+        elapsed = time.monotonic() - started_at
+        self.logger.info("load parsed: %d races in %.1fs, parser version %d", loaded, elapsed, self.parsed_store.parser_version)
+        self.writer.log_insert_counts()
+
+    # 現在より古いバージョンのパーサーで取り込んだレースのみ、アーカイブから再パースして更新
+    def reparse(self, race_id_from: int|None = None, race_id_to: int|None = None) -> None:
+        race_ids = set(self.db_crud.get_outdated_race_ids(PARSER_VERSION, race_id_from, race_id_to))
+        self.logger.info("reparse: %d races parsed before parser version %d", len(race_ids), PARSER_VERSION)
+        if len(race_ids) == 0:
+            return
 
-                #上りタイム
-                last_phase = str(columns.eq(11).text())
-                try:
-                    last_phase = float(last_phase)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    last_phase = None
+        self.writer.update = True
+        self.reingest(race_id_from, race_id_to, race_ids=race_ids)
+
+    # アーカイブ済みのページを従来のパーサー(pyquery)とlxmlのパーサーでパースし、結果と速度を比較
+    def verify_parser(self, race_id_from: int|None = None, race_id_to: int|None = None, limit: int|None = None) -> bool:
+        race_ids = [race_id for race_id in self.archive.race_ids()
+            if (race_id_from is None or race_id >= race_id_from) and (race_id_to is None or race_id <= race_id_to)]
+        if limit is not None:
+            race_ids = race_ids[:limit]
+
+        matched = 0
+        mismatched: list[int] = []
+        elapsed_pyquery = 0.0
+        elapsed_lxml = 0.0
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.parse_workers, initializer=_ignore_sigint) as executor:
+            futures: dict[concurrent.futures.Future, int] = {}
+            pages = self.archive.scan(race_ids)
+
+            while True:
+                for race_id, meta, compressed in pages:
+                    futures[executor.submit(verify_race, race_id, compressed,
+                        self.archive.dict_dir, meta.get("charset", "utf-8"), self.logger)] = race_id
+                    if len(futures) >= self.parse_workers * 4:
+                        break
 
-                #単勝オッズ
-                odds = str(columns.eq(12).text())
-                try:
-                    odds = float(odds)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    odds = None
+                if len(futures) == 0:
+                    break
+
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    race_id = futures.pop(future)
+                    same, elapsed_old, elapsed_new = future.result()
+                    elapsed_pyquery += elapsed_old
+                    elapsed_lxml += elapsed_new
+                    if same:
+                        matched += 1
+                    else:
+                        mismatched.append(race_id)
+                        self.logger.warning("race_id: %d, parser output mismatch", race_id)
+
+        self.logger.info("verify parser: %d pages, matched %d, mismatched %d", len(race_ids), matched, len(mismatched))
+        if elapsed_lxml > 0:
+            self.logger.info("pyquery %.2fms/page, lxml %.2fms/page (x%.1f)",
+                elapsed_pyquery * 1000 / len(race_ids), elapsed_lxml * 1000 / len(race_ids), elapsed_pyquery / elapsed_lxml)
+        return len(mismatched) == 0
+
+# プロセスプールのワーカーで実行するため、モジュール関数として定義
+# 結果はpickle可能なdict/listのみで返す
+def parse_race(race_id: int, html: str|None, filepath: str|None, logger: Logger,
+               compressed: bytes|None = None, dict_dir: str|None = None, charset: str = "utf-8") -> dict|None:
+    if html is None and compressed is None and filepath is not None:
+        compressed = _read_bytes(filepath)
+    if html is None and compressed is not None:
+        # 取得時の文字コードのまま格納しているため、ここで一度だけデコードする
+        html = decompress_page(compressed, dict_dir).decode(charset, errors="replace")
+    if html is None:
+        return None
+    page = parse_race_page(race_id, html, logger)
+    if page is None:
+        return None
+    record = page.to_record()
+    # エラーページ・ログイン画面など、レースのページでない場合は開催日が取れない
+    if record["race_info"]["date"] is None:
+        logger.warning("race_id: %d, not a race page", race_id)
+        return None
+    return record
+
+# 2つのパーサーで同じページをパースし、(一致したか, pyquery の処理時間, lxml の処理時間) を返す
+def verify_race(race_id: int, compressed: bytes, dict_dir: str|None, charset: str, logger: Logger) -> tuple[bool, float, float]:
+    html = decompress_page(compressed, dict_dir).decode(charset, errors="replace")
+
+    started_at = time.perf_counter()
+    expected = parse_race_html(race_id, html, logger)
+    elapsed_pyquery = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    page = parse_race_page(race_id, html, logger)
+    elapsed_lxml = time.perf_counter() - started_at
+
+    actual = page.to_record() if page is not None else None
+    if actual is not None:
+        actual["race_info"].pop("parser_version")
+    return expected == actual, elapsed_pyquery, elapsed_lxml
+
+# HTMLをパースし、書き込み用のレコードを作成(pyqueryによる従来のパーサー、verify_race での比較に使用)
+def parse_race_html(race_id: int, html: str, logger: Logger) -> dict|None:
+    try:
+        dataset_horse :list   = []
+        dataset_jockey :list  = []
+        dataset_trainer :list = []
+        dataset_owner :list   = []
+        dataset_result :list  = []
+        dataset_payoff :list  = []
+
+        dom = pq(html)
+        race_head = dom("html body div#page div#main div.race_head")
+
+        # init
+        data_race_name = None
+        data_distance = None
+        data_weather = None
+        data_post_time = None
+        data_race_number = None
+        data_track_surface = None
+        data_track_condition = None
+        data_track_condition_org = None
+        data_track_condition_score = None
+        data_run_direction = None
+        data_track_surface_org = None
+        data_place_detail = None
+        data_race_class = None
+        data_date = None
+
+        data_race_number_text = str(race_head("dl.racedata dt").text())
+        if data_race_number_text:
+            data_race_number = int(data_race_number_text.split(" ", 1)[0])
+        else:
+            data_race_number = None
 
-                #人気
-                popularity = str(columns.eq(13).text())
-                try:
-                    popularity = int(popularity)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    popularity = None
-
-                #馬体重
-                horse_weight = None
-                horse_weight_diff = None
-                matchese = None
-                matchese = re.match(r'^(\d+)\(\+?(\-?\d+)\)$', str(columns.eq(14).text()))
-                if matchese:
-                    horse_weight = matchese.group(1)
-                    horse_weight_diff = matchese.group(2)
-
-                #備考
-                remark = columns.eq(17).text()
-                if remark == "":
-                    remark = None
-
-                # 厩舎
-                stable = '不明'
-                matchese = None
-                matchese = re.match(r'\[(.)\]', str(columns.eq(18).text()))
-                if matchese:
-                    stable = matchese.group(1)
+        data_race_name = race_head("dl.racedata dd h1").text()
+
+        # track_surface, distance, weather, track_condition, post_time
+        race_info_text = str(race_head("dl.racedata dd p span").text())
+        matchese: re.Match | None = re.match(
+            r'^([^\d ]+).*?(\d{4})m\s*/\s*天候 : (\w+)\s*/\s*(.+)\s+/\s+発走 : (\d{1,2}:\d{1,2})',
+            race_info_text,
+            re.U
+        )
+        if matchese:
+            data_track_surface_org = matchese.group(1)
+            if re.search(r'^芝', data_track_surface_org):
+                data_track_surface = "芝"
+            elif re.search(r'^ダ', data_track_surface_org):
+                data_track_surface = "ダート"
+            elif re.search(r'^障', data_track_surface_org):
+                data_track_surface = "障害"
+
+            if re.search(r'^.*左', data_track_surface_org):
+                data_run_direction = "左"
+            elif re.search(r'^.*右', data_track_surface_org):
+                data_run_direction = "右"
+            elif re.search(r'^.*直線', data_track_surface_org):
+                data_run_direction = "直線"
+
+            if data_run_direction is not None and re.search(r'^.*外$', data_track_surface_org):
+                data_run_direction = data_run_direction + " 外"
+
+            data_distance = int(matchese.group(2))
+
+            data_weather = matchese.group(3)
+
+            data_track_condition_org = matchese.group(4)
+            matchese_condition = re.match(r'^.*?\s*:\s*(\w+)\s*', data_track_condition_org, re.U)
+            if matchese_condition:
+                data_track_condition = matchese_condition.group(1)
+
+            data_post_time = matchese.group(5)
+
+        # date, place_detail, class
+        text_value = str(race_head("div.mainrace_data p").eq(1).text()).replace('\u00A0', ' ').strip()
+        matchese = re.match(r'^(\d{4})年\s*(\d{1,2})月\s*(\d{1,2})日\s*(\S+?)(?:\s+(.+))?$', text_value)
+        if matchese:
+            data_date = matchese.group(1) + "-" + matchese.group(2) + "-" + matchese.group(3)
+            data_place_detail = matchese.group(4)
+            data_race_class = matchese.group(5)
+
+        race_head = None
+
+        dataset_info: dict = {
+            "id":race_id,
+            "race_name":data_race_name,
+            "distance":data_distance,
+            "weather":data_weather,
+            "post_time":data_post_time,
+            "race_number":data_race_number,
+            "run_direction":data_run_direction,
+            "track_surface":data_track_surface,
+            "track_condition":data_track_condition,
+            "track_condition_score":data_track_condition_score,
+            "date":data_date,
+            "place_detail":data_place_detail,
+            "race_grade":SkylarkUtil.convertToClass2Int(data_race_class),
+            "race_class":data_race_class
+        }
+
+
+        race_result = dom("html body div#page div#contents_liquid table tr")
+        for result_row in race_result[1:]:
+            columns = pq(result_row).find("td")
+
+            #着順
+            order_of_finish = str(columns.eq(0).text())
+            try:
+                order_of_finish = int(order_of_finish)
+            except ValueError as ex:
+                #logger.warning(ex)
+                order_of_finish = None
 
-                #調教師
-                trainer_id = str(columns.eq(18).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
-                trainer_name = columns.eq(18).find("a").eq(0).text()
+            #枠番
+            bracket_number = str(columns.eq(1).text())
+            try:
+                bracket_number = int(bracket_number)
+            except ValueError as ex:
+                logger.warning(ex)
 
-                #馬主
-                owner_id = str(columns.eq(19).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
-                owner_name = columns.eq(19).find("a").eq(0).text()
+            #馬番
+            horse_number = str(columns.eq(2).text())
+            try:
+                horse_number = int(horse_number)
+            except ValueError as ex:
+                logger.warning(ex)
 
-                #賞金
-                earning_money = str(columns.eq(20).text()).replace(",", "")
-                try:
-                    earning_money = float(earning_money)
-                except ValueError as ex:
-                    #self.logger.warning(ex)
-                    earning_money = 0
-
-                dataset_horse.append({
-                    "id":horse_id,
-                    "horse_name":horse_name
-                })
+            #馬ID
+            horse_id = str(columns.eq(3).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+            try:
+                horse_id = int(horse_id)
+            except ValueError as ex:
+                logger.warning(ex)
+
+            #馬名
+            horse_name = str(columns.eq(3).find("a").eq(0).text())
+
+            #性別、年齢
+            sex = None
+            age = 0
+            matchese = None
+            matchese = re.match(r'^(.)(\d+)$', str(columns.eq(4).text()))
+            if matchese:
+                sex = matchese.group(1)
+                age = int(matchese.group(2))
 
-                dataset_jockey.append({
-                    "id":jockey_id,
-                    "jockey_name":jockey_name
-                })
+            #斤量
+            basis_weight = float(str(columns.eq(5).text()))
 
-                dataset_trainer.append({
-                    "id":trainer_id,
-                    "trainer_name":trainer_name
-                })
+            #騎手
+            jockey_id = str(columns.eq(6).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+            jockey_name = columns.eq(6).find("a").eq(0).text()
 
-                dataset_owner.append({
-                    "id":owner_id,
-                    "owner_name":owner_name
-                })
+            #タイム
+            finishing_time = None
+            matchese = re.match(r'^(\d+:\d+\.\d+)$', str(columns.eq(7).text()))
+            if matchese:
+                finishing_time = '00:'+matchese.group(1)
 
-                dataset_result.append({
-                    "race_id":race_id,
-                    "horse_number":horse_number,
-                    "order_of_finish":order_of_finish,
-                    "bracket_number":bracket_number,
-                    "horse_id":horse_id,
-                    "sex":sex,
-                    "age":age,
-                    "basis_weight":basis_weight,
-                    "jockey_id":jockey_id,
-                    "finishing_time":finishing_time,
-                    "margin":margin,
-                    "speed_figure":speed_figure,
-                    "passing_rank":passing_rank,
-                    "last_phase":last_phase,
-                    "odds":odds,
-                    "popularity":popularity,
-                    "horse_weight":horse_weight,
-                    "horse_weight_diff":horse_weight_diff,
-                    "remark":remark,
-                    "stable":stable,
-                    "trainer_id":trainer_id,
-                    "owner_id":owner_id,
-                    "earning_money":earning_money
-                })
+            #着差
+            margin = str(columns.eq(8).text())
 
-            race_result = None
-            db_crud.insert_horses(dataset_horse)
-            db_crud.insert_jockeys(dataset_jockey)
-            db_crud.insert_trainers(dataset_trainer)
-            db_crud.insert_owners(dataset_owner)
-            db_crud.insert_race_results(dataset_result)
-
-            pay_block = dom("html body div#page div#contents dl.pay_block tr")
-            for pay_result in pay_block:
-                columns = pq(pay_result).find("th")
-                ticket_type = SkylarkUtil.convertToTicketType2Int(columns.eq(0).text())  # type: ignore
-                if ticket_type is None:
-                    self.logger.warning("Unknown ticket type, skip: %s", columns.eq(0).text())
-                    continue
+            #タイム指数(有料)
+            try:
+                speed_figure = int(str(columns.eq(9).text()))
+            except ValueError as ex:
+                #logger.warning(ex)
+                speed_figure =  None
 
-                columns = pq(pay_result).find("td")
-                horse_numbers_list = str(columns.eq(0).html()).split("<br />")
-                payoff_list = str(columns.eq(1).html()).split("<br />")
-                popularity_list = str(columns.eq(2).html()).split("<br />")
-
-                idx = 0
-                while idx < len(horse_numbers_list):
-                    dataset_payoff.append({
-                        "race_id":race_id,
-                        "ticket_type":ticket_type,
-                        "horse_numbers":horse_numbers_list[idx].replace(" ", "").replace("→", "->"),
-                        "payoff":int(payoff_list[idx].replace(",", "")),
-                        "popularity":int(popularity_list[idx])
-                    })
-                    idx = idx + 1
-
-            pay_block = None
-            db_crud.insert_payoffs(dataset_payoff)
-        except Exception as ex:
-            self.logger.error(ex)
+            #通過
+            passing_rank = str(columns.eq(10).text())
+
+            #上りタイム
+            last_phase = str(columns.eq(11).text())
+            try:
+                last_phase = float(last_phase)
+            except ValueError as ex:
+                #logger.warning(ex)
+                last_phase = None
+
+            #単勝オッズ
+            odds = str(columns.eq(12).text())
+            try:
+                odds = float(odds)
+            except ValueError as ex:
+                #logger.warning(ex)
+                odds = None
+
+            #人気
+            popularity = str(columns.eq(13).text())
+            try:
+                popularity = int(popularity)
+            except ValueError as ex:
+                #logger.warning(ex)
+                popularity = None
+
+            #馬体重
+            horse_weight = None
+            horse_weight_diff = None
+            matchese = None
+            matchese = re.match(r'^(\d+)\(\+?(\-?\d+)\)$', str(columns.eq(14).text()))
+            if matchese:
+                horse_weight = matchese.group(1)
+                horse_weight_diff = matchese.group(2)
+
+            #備考
+            remark = columns.eq(17).text()
+            if remark == "":
+                remark = None
+
+            # 厩舎
+            stable = '不明'
+            matchese = None
+            matchese = re.match(r'\[(.)\]', str(columns.eq(18).text()))
+            if matchese:
+                stable = matchese.group(1)
+
+            #調教師
+            trainer_id = str(columns.eq(18).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+            trainer_name = columns.eq(18).find("a").eq(0).text()
+
+            #馬主
+            owner_id = str(columns.eq(19).find("a").eq(0).attr("href")).rsplit("/", 2)[1]
+            owner_name = columns.eq(19).find("a").eq(0).text()
+
+            #賞金
+            earning_money = str(columns.eq(20).text()).replace(",", "")
+            try:
+                earning_money = float(earning_money)
+            except ValueError as ex:
+                #logger.warning(ex)
+                earning_money = 0
+
+            dataset_horse.append({
+                "id":horse_id,
+                "horse_name":horse_name
+            })
+
+            dataset_jockey.append({
+                "id":jockey_id,
+                "jockey_name":jockey_name
+            })
+
+            dataset_trainer.append({
+                "id":trainer_id,
+                "trainer_name":trainer_name
+            })
+
+            dataset_owner.append({
+                "id":owner_id,
+                "owner_name":owner_name
+            })
+
+            dataset_result.append({
+                "race_id":race_id,
+                "horse_number":horse_number,
+                "order_of_finish":order_of_finish,
+                "bracket_number":bracket_number,
+                "horse_id":horse_id,
+                "sex":sex,
+                "age":age,
+                "basis_weight":basis_weight,
+                "jockey_id":jockey_id,
+                "finishing_time":finishing_time,
+                "margin":margin,
+                "speed_figure":speed_figure,
+                "passing_rank":passing_rank,
+                "last_phase":last_phase,
+                "odds":odds,
+                "popularity":popularity,
+                "horse_weight":horse_weight,
+                "horse_weight_diff":horse_weight_diff,
+                "remark":remark,
+                "stable":stable,
+                "trainer_id":trainer_id,
+                "owner_id":owner_id,
+                "earning_money":earning_money
+            })
+
+        race_result = None
+
+        pay_block = dom("html body div#page div#contents dl.pay_block tr")
+        for pay_result in pay_block:
+            columns = pq(pay_result).find("th")
+            ticket_type = SkylarkUtil.convertToTicketType2Int(columns.eq(0).text())  # type: ignore
+            if ticket_type is None:
+                logger.warning("Unknown ticket type, skip: %s", columns.eq(0).text())
+                continue
+
+            columns = pq(pay_result).find("td")
+            horse_numbers_list = re.split(r"<br\s*/?>", str(columns.eq(0).html()))
+            payoff_list = re.split(r"<br\s*/?>", str(columns.eq(1).html()))
+            popularity_list = re.split(r"<br\s*/?>", str(columns.eq(2).html()))
+
+            idx = 0
+            while idx < len(horse_numbers_list):
+                dataset_payoff.append({
+                    "race_id":race_id,
+                    "ticket_type":ticket_type,
+                    "horse_numbers":horse_numbers_list[idx].replace(" ", "").replace("→", "->"),
+                    "payoff":int(payoff_list[idx].replace(",", "")),
+                    "popularity":int(popularity_list[idx])
+                })
+                idx = idx + 1
+
+        pay_block = None
+
+        return {
+            "race_info":dataset_info,
+            "horses":dataset_horse,
+            "jockeys":dataset_jockey,
+            "trainers":dataset_trainer,
+            "owners":dataset_owner,
+            "race_results":dataset_result,
+            "payoffs":dataset_payoff
+        }
+    except Exception as ex:
+        logger.error(ex)
+    return None
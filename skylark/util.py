@@ -5,6 +5,8 @@
 # This software is released under the MIT License.
 #
 
+import datetime
+
 class SkylarkUtil:
     ticket_type_list = (
         "単勝",
@@ -48,3 +50,14 @@ class SkylarkUtil:
             count += 1
 
         return None
+
+    # parse_race_html が作成する "YYYY-M-D" 形式の日付を変換
+    @staticmethod
+    def convertToDate(value: str|None) -> datetime.date|None:
+        if value is None:
+            return None
+        try:
+            year, month, day = value.split("-")
+            return datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            return None
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (c) MINETA "m10i" Hiroki <h-mineta@0nyx.net>
+# This software is released under the MIT License.
+#
+
+from logging import Logger
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue as queue_module
+import threading
+import time
+
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from skylark.crud import SkylarkCrud
+
+# 接続断・デッドロックなど、再試行すれば成功し得る失敗か
+def _is_transient(ex: Exception) -> bool:
+    if isinstance(ex, (OperationalError, InterfaceError, PoolTimeoutError)):
+        return True
+    return isinstance(ex, DBAPIError) and ex.connection_invalidated
+
+class SkylarkRaceWriter:
+    """
+    パース済みレースをまとめてコミットする書き込み器です。
+    batch_size 件たまるか、最初の1件から max_latency 秒経過した時点で1トランザクションで書き込みます。
+    """
+    def __init__(self, db_crud: SkylarkCrud, logger: Logger, batch_size: int|None = None, max_latency: float|None = None,
+                 update: bool = False):
+        self.db_crud = db_crud
+        self.logger = logger
+
+        if batch_size is None:
+            batch_size = int(os.getenv("DB_GROUP_COMMIT_SIZE", "1"))
+        if max_latency is None:
+            max_latency = float(os.getenv("DB_GROUP_COMMIT_LATENCY", "5"))
+        self.batch_size: int = max(1, batch_size)
+        self.max_latency: float = max_latency
+        # 既存の行を更新する(再取得したレースの訂正を反映する)
+        self.update: bool = update
+
+        self.pending: list = []
+        self.pending_since: float|None = None
+        self.lock = threading.Lock()
+
+        self.stored_races: int = 0
+        self.failed_races: int = 0
+        # テーブル毎の [書き込み件数, スキップ件数]
+        self.insert_counts: dict[str, list[int]] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, record: dict) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if len(self.pending) == 0:
+                self.pending_since = now
+            self.pending.append(record)
+            # 次々に届く間も、最初の1件から max_latency 秒を超えて待たせない
+            if len(self.pending) < self.batch_size and now - self.pending_since < self.max_latency:
+                return
+            batch = self._take_pending()
+        self._store(batch)
+
+    # 待ち時間の上限を超えていれば書き込み
+    def flush_if_due(self) -> None:
+        with self.lock:
+            if self.pending_since is None or time.monotonic() - self.pending_since < self.max_latency:
+                return
+            batch = self._take_pending()
+        self._store(batch)
+
+    # 待ち時間の上限までの秒数(書き込み待ちがない場合は None)
+    def seconds_until_due(self) -> float|None:
+        with self.lock:
+            if self.pending_since is None:
+                return None
+            return max(0.0, self.pending_since + self.max_latency - time.monotonic())
+
+    def flush(self) -> None:
+        with self.lock:
+            batch = self._take_pending()
+        self._store(batch)
+
+    def _take_pending(self) -> list:
+        batch = self.pending
+        self.pending = []
+        self.pending_since = None
+        return batch
+
+    def _store(self, batch: list) -> None:
+        if len(batch) == 0:
+            return
+
+        try:
+            self._count(self.db_crud.store_races(batch, update=self.update), len(batch))
+            return
+        except Exception as ex:
+            if len(batch) == 1:
+                race_id = batch[0]["race_info"]["id"]
+                self.logger.error("race_id: %d, store failed: %s", race_id, ex)
+                if _is_transient(ex):
+                    self.db_crud.fail_crawl_job(race_id, str(ex))
+                else:
+                    # データの不正は同じページを再パースしても変わらないため、再試行しない
+                    self.db_crud.reject_crawl_job(race_id, str(ex))
+                with self.lock:
+                    self.failed_races += 1
+                return
+            self.logger.warning("group commit of %d races failed, retry one by one: %s", len(batch), ex)
+
+        # まとめての書き込みに失敗した場合は1レースずつ書き込み、失敗したレースのみ取りこぼす
+        for record in batch:
+            self._store([record])
+
+    def _count(self, counts: dict[str, tuple[int, int]], races: int) -> None:
+        with self.lock:
+            self.stored_races += races
+            for table_name, (written, skipped) in counts.items():
+                total = self.insert_counts.setdefault(table_name, [0, 0])
+                total[0] += written
+                total[1] += skipped
+
+    def log_insert_counts(self) -> None:
+        with self.lock:
+            self.logger.info("races: stored %d, failed %d", self.stored_races, self.failed_races)
+            for table_name, (written, skipped) in self.insert_counts.items():
+                self.logger.info("%s: inserted %d, skipped %d", table_name, written, skipped)
+
+class SkylarkFeatureWriter:
+    """
+    特徴量を書き込む専用のプロセスです。
+    計算するワーカーは queue に feature_tbl の行のリストを入れ、書き込みプロセスは
+    batch_size 件毎に INSERT ... ON DUPLICATE KEY UPDATE でまとめて書き込みます。
+    """
+    def __init__(self, db_url: str, logger: Logger, batch_size: int|None = None, queue_size: int|None = None):
+        self.db_url = db_url
+        self.logger = logger
+
+        if batch_size is None:
+            batch_size = int(os.getenv("FEATURE_UPSERT_BATCH_SIZE", "2000"))
+        if queue_size is None:
+            queue_size = int(os.getenv("FEATURE_WRITE_QUEUE_SIZE", "64"))
+        self.batch_size: int = max(1, batch_size)
+
+        context = multiprocessing.get_context()
+        self.queue = context.Queue(maxsize=max(1, queue_size))
+        # 書き込みプロセスが終了したか(ワーカーはキューと合わせて受け取り、put で待ち続けないようにする)
+        self.stopped = context.Event()
+        # 書き込み件数, 書き込めなかった件数
+        self.written = context.Value("q", 0)
+        self.failed = context.Value("q", 0)
+        self.process = context.Process(target=_write_features,
+            args=(db_url, logger, self.queue, self.stopped, self.batch_size, self.written, self.failed), name="feature-writer")
+        self.monitor: threading.Thread|None = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self) -> None:
+        self.process.start()
+        # シグナルなどで書き込みプロセスが強制終了した場合も stopped を立てる
+        self.monitor = threading.Thread(target=self._watch, name="feature-writer-monitor", daemon=True)
+        self.monitor.start()
+
+    def _watch(self) -> None:
+        # join は close() で行うため、終了の検知は sentinel で行う
+        multiprocessing.connection.wait([self.process.sentinel])
+        self.stopped.set()
+
+    def put(self, dataset_list: list[dict]) -> None:
+        put_features(self.queue, self.stopped, dataset_list)
+
+    def close(self) -> int:
+        """
+        キューに残っている行を書き込んでからプロセスを終了します。戻り値は書き込んだ行数です。
+        書き込みプロセスが途中で終了していた場合は RuntimeError を送出します。
+        """
+        try:
+            put_features(self.queue, self.stopped, None)
+        except RuntimeError:
+            pass
+        self.process.join()
+        self.logger.info("features: written %d, failed %d", self.written.value, self.failed.value)
+        if self.process.exitcode != 0:
+            raise RuntimeError(f"feature writer exited with code {self.process.exitcode}")
+        return self.written.value
+
+def put_features(queue, stopped, dataset_list: list[dict]|None, timeout: float = 1.0) -> None:
+    """
+    書き込みプロセスのキューに行を入れます(None は終了の合図)。
+    書き込みプロセスが終了している場合はキューが空かないため、待ち続けずに RuntimeError を送出します。
+    """
+    if dataset_list is not None and len(dataset_list) == 0:
+        return
+    while True:
+        if stopped.is_set():
+            # 読み出されない行を送るスレッドの終了を待たない(待つとプロセスが終了できない)
+            queue.cancel_join_thread()
+            raise RuntimeError("feature writer is not running")
+        try:
+            queue.put(dataset_list, timeout=timeout)
+            return
+        except queue_module.Full:
+            continue
+
+# 書き込みプロセスの本体(None を受け取るまでキューの行を書き込む)
+def _write_features(db_url: str, logger: Logger, queue, stopped, batch_size: int, written, failed) -> None:
+    try:
+        _drain_features(db_url, logger, queue, batch_size, written, failed)
+    finally:
+        stopped.set()
+
+def _drain_features(db_url: str, logger: Logger, queue, batch_size: int, written, failed) -> None:
+    # fork で引き継いだ親プロセスの接続プールは使わない
+    SkylarkCrud.forget_engines()
+    db_crud = SkylarkCrud(db_url, logger=logger)
+
+    def store(batch: list[dict]) -> None:
+        try:
+            count = db_crud.bulk_upsert_features(batch)[0]
+            with written.get_lock():
+                written.value += count
+        except Exception as ex:
+            # 書き込めなくてもキューは読み続ける(ワーカーが put で止まらないように)
+            logger.error("failed to write %d features: %s", len(batch), ex)
+            with failed.get_lock():
+                failed.value += len(batch)
+
+    pending: list[dict] = []
+    while True:
+        dataset_list = queue.get()
+        if dataset_list is None:
+            break
+        pending.extend(dataset_list)
+        while len(pending) >= batch_size:
+            store(pending[:batch_size])
+            pending = pending[batch_size:]
+    if len(pending) > 0:
+        store(pending)
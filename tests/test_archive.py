@@ -0,0 +1,57 @@
+import logging
+import os
+import struct
+
+from skylark.archive import SkylarkRawArchive, _INDEX_ENTRY
+
+logger = logging.getLogger(__name__)
+
+def test_index_entry_layout():
+    assert _INDEX_ENTRY.size == 32
+    data = _INDEX_ENTRY.pack(202301010101, 1 << 40, 12345, 1700000000.5)
+    assert data[:8] == struct.pack("<Q", 202301010101)
+    assert data[8:16] == struct.pack("<Q", 1 << 40)
+    assert data[16:20] == struct.pack("<I", 12345)
+    assert data[20:28] == struct.pack("<d", 1700000000.5)
+    assert data[28:] == b"\x00" * 4
+
+# 書き込んだページを、pages.idx を開き直しても同じく読み込めることを確認
+def test_round_trip_and_reopen(tmp_path):
+    directory = str(tmp_path / "archive")
+    pages = {
+        202301010101: (b"page-1", {"charset": "euc-jp", "etag": '"a"'}),
+        202301010102: (b"page-2" * 100, None),
+    }
+
+    with SkylarkRawArchive(directory, logger) as archive:
+        for race_id, (payload, meta) in pages.items():
+            archive.put(race_id, payload, meta, fetched_at=1700000000.25)
+        # 同じレースを追記した場合は後のものが有効
+        archive.put(202301010101, b"page-1-new", {"charset": "utf-8"}, fetched_at=1700000100.0)
+        assert archive.get(202301010101) == ({"charset": "utf-8"}, b"page-1-new")
+
+    assert os.path.getsize(os.path.join(directory, "pages.idx")) == 3 * _INDEX_ENTRY.size
+
+    with SkylarkRawArchive(directory, logger) as archive:
+        assert len(archive) == 2
+        assert archive.get(202301010101) == ({"charset": "utf-8"}, b"page-1-new")
+        assert archive.get(202301010102) == ({}, b"page-2" * 100)
+        assert archive.entry(202301010101)[2] == 1700000100.0
+        assert archive.entry(202301010102)[2] == 1700000000.25
+        assert archive.get(202301010103) is None
+
+        # 開き直したアーカイブへの追記も、もう一度開き直して読み込める
+        archive.put(202301010103, b"page-3", {"charset": "euc-jp"}, fetched_at=1700000200.0)
+
+    with SkylarkRawArchive(directory, logger) as archive:
+        assert sorted(archive.race_ids()) == [202301010101, 202301010102, 202301010103]
+        assert archive.get(202301010103) == ({"charset": "euc-jp"}, b"page-3")
+
+# 他のプロセスが追記したエントリも、開いたままのアーカイブから読み込めることを確認
+def test_reads_entries_appended_by_another_writer(tmp_path):
+    directory = str(tmp_path / "archive")
+    with SkylarkRawArchive(directory, logger) as reader, SkylarkRawArchive(directory, logger) as writer:
+        assert 202301010101 not in reader
+        writer.put(202301010101, b"page-1", {"charset": "euc-jp"})
+        assert 202301010101 in reader
+        assert reader.get(202301010101) == ({"charset": "euc-jp"}, b"page-1")
@@ -0,0 +1,207 @@
+import datetime
+from decimal import Decimal, ROUND_HALF_UP
+import logging
+import struct
+
+import numpy as np
+import pytest
+from sqlalchemy import event, insert
+
+from skylark.crud import SkylarkCrud
+from skylark.feature import SkylarkFeature, SkylarkFeatureEngine, SkylarkFeatureStream, _decimal_avgs
+from skylark.models import Base, RaceInfo, RaceResult
+
+logger = logging.getLogger(__name__)
+
+class _MySQLAvg:
+    """
+    SQLite の AVG を MySQL と同じ結果にする集約関数。
+    整数列は小数点以下4桁に四捨五入した値(Decimal の文字列)、
+    FLOAT列は単精度に丸めた値を読み込んだ順(新しい順)に足した平均を返します。
+    """
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        if len(self.values) == 0:
+            return None
+        if all(isinstance(value, int) for value in self.values):
+            average = Decimal(sum(self.values)) / Decimal(len(self.values))
+            return str(average.quantize(Decimal("0.0001"), rounding=ROUND_HALF_UP))
+        total = 0.0
+        for value in self.values:
+            total += struct.unpack("f", struct.pack("f", value))[0]
+        return total / len(self.values)
+
+def _race(race_id: int, date: datetime.date, distance: int|None) -> dict:
+    return {"id": race_id, "race_name": "race", "date": date, "distance": distance,
+        "race_number": 1, "place_detail": "place"}
+
+def _result(race_id: int, horse_number: int, horse_id: int, speed_figure: int|None,
+        order_of_finish: int|None, earning_money: float|None) -> dict:
+    return {"race_id": race_id, "horse_number": horse_number, "horse_id": horse_id,
+        "jockey_id": f"{horse_id % 7:05d}", "trainer_id": f"{horse_id % 5:05d}",
+        "speed_figure": speed_figure, "order_of_finish": order_of_finish, "earning_money": earning_money,
+        "bracket_number": 1, "sex": "牡", "age": 3, "basis_weight": 55.0, "margin": "",
+        "passing_rank": "", "stable": "東", "owner_id": "000001"}
+
+def _dataset() -> tuple[list[dict], list[dict]]:
+    races = []
+    results = []
+    start = datetime.date(2020, 1, 5)
+    distances = (1200, 1600, 2000, 2400)
+
+    # 馬1: 130走(直近5走・100走の範囲を超える)、欠損値を含む
+    # 馬2: 馬1と同じ日の別のレースに出走
+    for week in range(130):
+        race_id = 202000000000 + week * 10
+        date = start + datetime.timedelta(weeks=week)
+        races.append(_race(race_id, date, None if week % 17 == 5 else distances[week % 4]))
+        results.append(_result(race_id, 1, 1001,
+            None if week % 7 == 3 else 40 + week * 13 % 71,
+            None if week % 11 == 4 else (0 if week % 23 == 9 else 1 + week * 5 % 14),
+            # 足す順で結果が変わるように、桁の大きく異なる賞金を混ぜる
+            None if week % 13 == 6 else (0.1 + week / 1000 if week % 3 == 0 else 98765.4 * (1 + week % 89))))
+        if week % 9 == 4:
+            results.append(_result(race_id, 2, 1002, 30 + week % 50, 1 + week % 3, week * 0.7))
+        if week % 6 == 0:
+            race_id += 1
+            races.append(_race(race_id, date, 1800))
+            results.append(_result(race_id, 1, 1002, 55 + week % 13, 2, 501.3 + week))
+
+    # 馬3: 同じ日に2走(同じ日の2走は互いに過去走に含めない)
+    start = datetime.date(2021, 4, 1)
+    days = (0, 14, 14, 28, 42, 56, 70)
+    for index, day in enumerate(days):
+        race_id = 202100000000 + index
+        races.append(_race(race_id, start + datetime.timedelta(days=day), 1600 if index % 2 else 2000))
+        # 並び順が決まらない同じ日の2走は、値を揃える
+        same_day = index in (1, 2)
+        results.append(_result(race_id, 3, 1003,
+            61 if same_day else 50 + index * 3,
+            2 if same_day else (index % 4) + 1,
+            333.3 if same_day else 100.0 * index + 0.1))
+
+    # 馬4: 全ての値が欠損
+    races.append(_race(202200000000, datetime.date(2022, 1, 1), None))
+    results.append(_result(202200000000, 4, 1004, None, None, None))
+    results.append(_result(202100000006, 5, 1004, None, None, None))
+    return races, results
+
+def _open_crud(path) -> SkylarkCrud:
+    db_crud = SkylarkCrud(f"sqlite:///{path}", logger)
+
+    @event.listens_for(db_crud.engine, "connect")
+    def register_avg(connection, connection_record):
+        connection.create_aggregate("avg", 1, _MySQLAvg)
+
+    Base.metadata.create_all(db_crud.engine)
+    return db_crud
+
+def _insert(db_crud: SkylarkCrud, races: list[dict], results: list[dict]) -> None:
+    race_ids = {race["id"] for race in races}
+    with db_crud.engine.begin() as connection:
+        connection.execute(insert(RaceInfo.__table__), races)
+        connection.execute(insert(RaceResult.__table__), [result for result in results if result["race_id"] in race_ids])
+
+@pytest.fixture
+def db_crud(tmp_path) -> SkylarkCrud:
+    db_crud = _open_crud(tmp_path / "feature.db")
+    _insert(db_crud, *_dataset())
+
+    # MySQL の AVG(整数列) は Decimal を返す
+    for name in ("get_speed_figure_avg", "get_winner_avg", "get_disavesr", "get_distance_avg"):
+        method = getattr(db_crud, name)
+        setattr(db_crud, name, lambda *args, method=method: _to_decimal(method(*args)))
+    yield db_crud
+    db_crud.engine.dispose()
+
+def _to_decimal(value):
+    return Decimal(value) if value is not None else None
+
+def test_decimal_avgs_round_half_up():
+    assert _decimal_avgs(np.array([1, -1, 2, 0]), np.array([32, 32, 3, 0])) == \
+        [Decimal("0.0313"), Decimal("-0.0313"), Decimal("0.6667"), None]
+
+# 一括計算の結果が、1行ずつDBに問い合わせる従来の実装と文字列として一致することを確認
+def test_engine_matches_per_row(db_crud: SkylarkCrud):
+    skylark_feature = SkylarkFeature(args=None, logger=logger)
+    expected = {}
+    for horse_id, race_id, horse_number in db_crud.get_race_result_keys():
+        dataset = skylark_feature.initialize(db_crud, race_id=race_id, horse_number=horse_number, write=False)
+        expected[(race_id, horse_id)] = dataset
+
+    engine = SkylarkFeatureEngine(logger=logger)
+    actual = {(dataset["race_id"], dataset["horse_id"]): dataset
+        for dataset in engine.compute(db_crud.get_feature_source())}
+
+    assert actual.keys() == expected.keys()
+    for key, dataset in expected.items():
+        assert actual[key]["calculation_result_json"] == dataset["calculation_result_json"], key
+        assert actual[key]["history_count"] == dataset["history_count"], key
+        assert actual[key] == dataset, key
+
+    # 直近100走の範囲を超える行と、過去走がない行を含む
+    history_counts = [dataset["history_count"] for dataset in expected.values()]
+    assert max(history_counts) > 100
+    assert 0 in history_counts
+
+def _by_key(dataset_list: list[dict]) -> dict[tuple[int, int], dict]:
+    return {(dataset["race_id"], dataset["horse_id"]): dataset for dataset in dataset_list}
+
+def _run_stream(stream: SkylarkFeatureStream, db_crud: SkylarkCrud) -> list[dict]:
+    # feature_tbl へは書き込まず(SQLiteでは INSERT ... ON DUPLICATE KEY UPDATE を使えない)、書き込む行を返す
+    written = []
+    def bulk_upsert_features(dataset_list, connection=None):
+        written.extend(dataset_list)
+        return (len(dataset_list), 0)
+    db_crud.bulk_upsert_features = bulk_upsert_features
+    assert stream.run(db_crud) == len(written)
+    return written
+
+# 開催日順に状態を更新する計算の結果が、一括計算と一致することを確認
+def test_stream_matches_engine(db_crud: SkylarkCrud, tmp_path):
+    stream = SkylarkFeatureStream(str(tmp_path / "feature_state.pickle"), logger, batch_size=50)
+    actual = _by_key(_run_stream(stream, db_crud))
+
+    engine = SkylarkFeatureEngine(logger=logger)
+    expected = _by_key(engine.compute(db_crud.get_feature_source()))
+    assert len(actual) == len(expected)
+    assert actual == expected
+
+# 途中まで処理して保存した状態から再開した結果が、1度に処理した結果と一致することを確認
+def test_stream_resumes_from_snapshot(tmp_path):
+    races, results = _dataset()
+    # 同じ日に2走した馬の開催日(2021-04-15)までを先に取り込む
+    cutoff = datetime.date(2021, 4, 15)
+
+    whole = _open_crud(tmp_path / "whole.db")
+    _insert(whole, races, results)
+    expected = _run_stream(SkylarkFeatureStream(str(tmp_path / "whole.pickle"), logger), whole)
+
+    db_crud = _open_crud(tmp_path / "resume.db")
+    snapshot_path = str(tmp_path / "resume.pickle")
+    _insert(db_crud, [race for race in races if race["date"] <= cutoff], results)
+    first = _run_stream(SkylarkFeatureStream(snapshot_path, logger), db_crud)
+
+    _insert(db_crud, [race for race in races if race["date"] > cutoff], results)
+    stream = SkylarkFeatureStream(snapshot_path, logger)
+    second = _run_stream(stream, db_crud)
+    assert stream.date == max(race["date"] for race in races)
+
+    assert 0 < len(first) < len(expected)
+    assert len(first) + len(second) == len(expected)
+    assert _by_key(first + second) == _by_key(expected)
+
+    # 再開すると保存した開催日より後のレースのみ処理する
+    assert _run_stream(SkylarkFeatureStream(snapshot_path, logger), db_crud) == []
+
+    # 保存した開催日以前のレースを後から取り込んだ場合は、最初から処理し直す
+    _insert(db_crud, [_race(201900000000, datetime.date(2019, 12, 1), 1600)],
+        [_result(201900000000, 1, 1001, 70, 1, 1000.0)])
+    replayed = _run_stream(SkylarkFeatureStream(snapshot_path, logger), db_crud)
+    assert len(replayed) == len(expected) + 1
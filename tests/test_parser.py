@@ -0,0 +1,32 @@
+import glob
+import logging
+import os
+import re
+
+import pytest
+
+from skylark.parser import parse_race_page
+from skylark.scraper import parse_race_html
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+FIXTURES = sorted(glob.glob(os.path.join(FIXTURE_DIR, "race_*.html")))
+
+logger = logging.getLogger(__name__)
+
+# lxml版のパーサーが、pyquery版の従来のパーサーと同じレコードを返すことを確認
+@pytest.mark.parametrize("path", FIXTURES, ids=os.path.basename)
+def test_parse_race_page_matches_parse_race_html(path: str):
+    race_id = int(re.search(r"race_(\d+)\.html$", path).group(1))
+    with open(path, encoding="utf-8") as f:
+        html = f.read()
+
+    expected = parse_race_html(race_id, html, logger)
+    page = parse_race_page(race_id, html, logger)
+    assert expected is not None
+    assert page is not None
+
+    actual = page.to_record()
+    actual["race_info"].pop("parser_version")
+    assert actual == expected
+    assert len(actual["race_results"]) > 0
+    assert len(actual["payoffs"]) > 0
@@ -0,0 +1,99 @@
+import logging
+import os
+import signal
+import time
+
+import pytest
+
+from skylark.writer import SkylarkFeatureWriter, SkylarkRaceWriter
+
+logger = logging.getLogger(__name__)
+
+class _RecordingCrud:
+    # store_races を呼ばれた時刻と件数を記録する
+    def __init__(self):
+        self.stored = []
+
+    def store_races(self, record_list: list, update: bool = False) -> dict:
+        self.stored.append((time.monotonic(), len(record_list)))
+        return {}
+
+def _record(race_id: int) -> dict:
+    return {"race_info": {"id": race_id}}
+
+# レースが途切れずに届く間も、一杯にならないバッチを max_latency 秒以内に書き込むことを確認
+def test_partial_batch_is_flushed_within_max_latency():
+    db_crud = _RecordingCrud()
+    max_latency = 0.2
+    interval = 0.01
+    writer = SkylarkRaceWriter(db_crud, logger, batch_size=1000, max_latency=max_latency)
+
+    started_at = time.monotonic()
+    race_id = 0
+    while time.monotonic() - started_at < max_latency * 5:
+        race_id += 1
+        writer.add(_record(race_id))
+        time.sleep(interval)
+
+    assert len(db_crud.stored) >= 3
+    assert all(count < 1000 for _, count in db_crud.stored)
+    # 各バッチの最初の1件が届いてから書き込むまでの時間
+    first_added_at = started_at
+    for stored_at, _ in db_crud.stored:
+        assert stored_at - first_added_at <= max_latency + interval * 5
+        first_added_at = stored_at
+
+    writer.flush()
+    assert sum(count for _, count in db_crud.stored) == race_id
+
+def test_full_batch_is_flushed_immediately():
+    db_crud = _RecordingCrud()
+    writer = SkylarkRaceWriter(db_crud, logger, batch_size=3, max_latency=60)
+
+    for race_id in range(1, 8):
+        writer.add(_record(race_id))
+
+    assert [count for _, count in db_crud.stored] == [3, 3]
+    assert writer.seconds_until_due() > 59
+    writer.flush()
+    assert [count for _, count in db_crud.stored] == [3, 3, 1]
+    assert writer.seconds_until_due() is None
+
+def _features(count: int) -> list[dict]:
+    return [{"horse_id": 1, "race_id": race_id, "jockey_id": "00001", "trainer_id": "00001",
+        "calculation_result_json": "{}", "feature_version": 1, "history_count": 0} for race_id in range(count)]
+
+# 書き込みプロセスが接続できずに終了した場合、put・close が待ち続けずに例外になることを確認
+def test_feature_writer_reports_failed_start():
+    feature_writer = SkylarkFeatureWriter("nosuchdialect://localhost/db", logger, queue_size=1)
+    feature_writer.start()
+
+    started_at = time.monotonic()
+    with pytest.raises(RuntimeError, match="not running"):
+        for _ in range(100):
+            feature_writer.put(_features(1))
+    with pytest.raises(RuntimeError, match="exited with code"):
+        feature_writer.close()
+    assert time.monotonic() - started_at < 30
+
+# 書き込みに失敗しても、書き込みプロセスはキューを読み続けることを確認
+def test_feature_writer_keeps_draining_after_upsert_errors(tmp_path):
+    # SQLite では INSERT ... ON DUPLICATE KEY UPDATE を使えないため、全ての書き込みが失敗する
+    feature_writer = SkylarkFeatureWriter(f"sqlite:///{tmp_path / 'feature.db'}", logger, batch_size=2, queue_size=1)
+    with feature_writer:
+        for _ in range(20):
+            feature_writer.put(_features(3))
+    assert feature_writer.written.value == 0
+    assert feature_writer.failed.value == 60
+
+# 書き込みプロセスが強制終了した場合も、put が待ち続けずに例外になることを確認
+def test_feature_writer_reports_killed_process(tmp_path):
+    feature_writer = SkylarkFeatureWriter(f"sqlite:///{tmp_path / 'feature.db'}", logger, queue_size=1)
+    feature_writer.start()
+    os.kill(feature_writer.process.pid, signal.SIGKILL)
+
+    with pytest.raises(RuntimeError, match="not running"):
+        for _ in range(100):
+            feature_writer.put(_features(1))
+    with pytest.raises(RuntimeError, match="exited with code"):
+        feature_writer.close()